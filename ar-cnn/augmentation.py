@@ -85,3 +85,166 @@ class AddAndRemoveAPercentageOfNotes():
         for _ in range(number_of_samples):
             result.append(self.apply_augmentation_to_sample(piano_roll))
         return result
+
+    @staticmethod
+    def create_notes_mask_batch(piano_rolls,
+                                sampling_percentages,
+                                notes_exists=True,
+                                random_state=np.random):
+        '''
+        Vectorized counterpart of create_notes_mask over a batch of flattened pianorolls.
+        Every cell gets a random rank and, per row, the lowest ranked candidate cells
+        are selected so that the same number of notes as create_notes_mask is picked.
+        :param piano_rolls: boolean array of shape (N, T * P)
+        :param sampling_percentages: array of N sampling percentages, one per row
+        :param notes_exists: select among cells with notes (True) or without notes (False)
+        :param random_state: np.random.RandomState to draw from, defaults to the global one
+        :return: boolean mask of shape (N, T * P) with the selected cells set
+        '''
+        candidates = piano_rolls if notes_exists else ~piano_rolls
+        num_candidates = np.count_nonzero(candidates, axis=1)
+        # Same count as create_notes_mask: the remaining
+        # floor(n * (1 - p / 100)) candidates are left untouched
+        num_selected = num_candidates - np.floor(
+            num_candidates * (1 - sampling_percentages / 100)).astype(np.int64)
+        num_selected = np.clip(num_selected, 0, num_candidates)
+        ranks = random_state.random_sample(piano_rolls.shape)
+        # Non candidates are ranked after every candidate
+        ranks[~candidates] = 2.0
+        sorted_ranks = np.sort(ranks, axis=1)
+        thresholds = sorted_ranks[np.arange(len(ranks)),
+                                  np.maximum(num_selected - 1, 0)]
+        mask = ranks <= thresholds[:, np.newaxis]
+        mask &= candidates
+        mask[num_selected == 0] = False
+        return mask
+
+    def sample_batch(self,
+                     piano_rolls,
+                     number_of_samples,
+                     random_state=np.random,
+                     out=None):
+        '''
+        Randomly adds and removes percentages of notes for a whole batch at once.
+        :param piano_rolls: pianorolls of shape (M, T, P), or a single (T, P) pianoroll
+        :param number_of_samples: number of augmented samples per pianoroll
+        :param random_state: np.random.RandomState to draw from, defaults to the global one
+        :param out: optional (inputs, targets) pair of C-contiguous buffers holding
+        M * number_of_samples * T * P elements each (e.g. (N, T, P, 1)), of any dtype
+        :return: inputs, targets - arrays of shape (M * number_of_samples, T, P),
+        where targets is the XOR between each input and its ground truth pianoroll
+        '''
+        piano_rolls = np.asarray(piano_rolls).astype(np.bool_, copy=False)
+        if piano_rolls.ndim == 2:
+            piano_rolls = piano_rolls[np.newaxis]
+        batch_shape = (len(piano_rolls) * number_of_samples, ) + \
+            piano_rolls.shape[1:]
+        if number_of_samples == 1:
+            ground_truth = piano_rolls.reshape(batch_shape[0], -1)
+        else:
+            ground_truth = np.repeat(piano_rolls, number_of_samples,
+                                     axis=0).reshape(batch_shape[0], -1)
+        if out is None:
+            out = (np.empty(batch_shape, dtype=np.bool_),
+                   np.empty(batch_shape, dtype=np.bool_))
+        for buffer in out:
+            if not buffer.flags.c_contiguous or buffer.size != ground_truth.size:
+                raise ValueError(
+                    "Output buffers must be C-contiguous with {} elements".
+                    format(ground_truth.size))
+        inputs = out[0].reshape(ground_truth.shape)
+        targets = out[1].reshape(ground_truth.shape)
+
+        sampling_percentages_remove = random_state.randint(
+            self.sampling_lower_bound_remove,
+            self.sampling_upper_bound_remove + 1,
+            size=batch_shape[0])
+        sampling_percentages_add = random_state.uniform(
+            self.sampling_lower_bound_add,
+            self.sampling_upper_bound_add,
+            size=batch_shape[0])
+        remove_mask = self.create_notes_mask_batch(
+            ground_truth,
+            sampling_percentages_remove,
+            notes_exists=True,
+            random_state=random_state)
+        add_mask = self.create_notes_mask_batch(ground_truth,
+                                                sampling_percentages_add,
+                                                notes_exists=False,
+                                                random_state=random_state)
+        # Removed and added cells are disjoint, so together they are
+        # exactly the cells where the input differs from the ground truth
+        np.logical_or(remove_mask, add_mask, out=targets)
+        np.logical_xor(ground_truth, targets, out=inputs)
+        return out
+
+
+class TransposeAndShiftNotes():
+    def __init__(self, max_pitch_transposition, max_time_shift):
+
+        # Maximum number of semitones a pianoroll is transposed up or down
+        self.max_pitch_transposition = max_pitch_transposition
+        # Maximum number of timesteps a pianoroll is shifted forward or backward
+        self.max_time_shift = max_time_shift
+
+    def get_time_shifts(self, number_of_samples, random_state=np.random):
+        '''
+        Draws a time shift for every pianoroll of a batch, e.g. to move the window
+        starts of a sample list that holds whole songs, see PackedPianoRollStore.unpack_batch
+        :param number_of_samples: number of pianorolls in the batch
+        :param random_state: np.random.RandomState to draw from, defaults to the global one
+        :return: array of time shifts in timesteps
+        '''
+        return random_state.randint(-self.max_time_shift,
+                                    self.max_time_shift + 1,
+                                    size=number_of_samples)
+
+    def apply_to_batch(self,
+                       piano_rolls,
+                       random_state=np.random,
+                       out=None,
+                       time_shifts=None):
+        '''
+        Randomly transposes and time shifts every pianoroll of a batch in one gather.
+        Transpositions are limited per pianoroll so that no note leaves the pitch range,
+        time shifts move the notes within the window and leave the timesteps shifted
+        in from outside the window empty.
+        :param piano_rolls: boolean array of shape (N, T, P)
+        :param random_state: np.random.RandomState to draw from, defaults to the global one
+        :param out: optional (N, T, P) buffer to write into, must not be piano_rolls
+        :param time_shifts: optional time shift of every pianoroll, drawn if not given
+        :return: transposed and shifted pianorolls
+        '''
+        number_of_samples, timesteps, pitches = piano_rolls.shape
+        active_pitches = piano_rolls.any(axis=1)
+        has_notes = active_pitches.any(axis=1)
+        lowest_pitches = np.where(has_notes, active_pitches.argmax(axis=1), 0)
+        highest_pitches = np.where(
+            has_notes, pitches - 1 - active_pitches[:, ::-1].argmax(axis=1),
+            pitches - 1)
+        pitch_shifts = random_state.randint(
+            np.maximum(-self.max_pitch_transposition, -lowest_pitches),
+            np.minimum(self.max_pitch_transposition,
+                       pitches - 1 - highest_pitches) + 1)
+        if time_shifts is None:
+            time_shifts = self.get_time_shifts(number_of_samples,
+                                               random_state)
+
+        time_indices = np.arange(timesteps) - np.asarray(time_shifts)[:,
+                                                                      np.newaxis]
+        # Timesteps shifted in from outside the window have no notes
+        valid_timesteps = (time_indices >= 0) & (time_indices < timesteps)
+        time_indices = np.clip(time_indices, 0, timesteps - 1)
+        pitch_indices = np.arange(pitches) - pitch_shifts[:, np.newaxis]
+        # Pitches shifted in from outside the range have no notes
+        valid_pitches = (pitch_indices >= 0) & (pitch_indices < pitches)
+        pitch_indices = np.clip(pitch_indices, 0, pitches - 1)
+        if out is None:
+            out = np.empty_like(piano_rolls)
+        out[...] = piano_rolls[np.arange(number_of_samples)[:, np.newaxis,
+                                                            np.newaxis],
+                               time_indices[:, :, np.newaxis],
+                               pitch_indices[:, np.newaxis, :]]
+        out &= valid_pitches[:, np.newaxis, :]
+        out &= valid_timesteps[:, :, np.newaxis]
+        return out
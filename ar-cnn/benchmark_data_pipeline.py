@@ -0,0 +1,236 @@
+# The MIT-Zero License
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Benchmarks the AR-CNN data pipeline on synthetic pianorolls.
+# Usage:
+#   python benchmark_data_pipeline.py --output results.json
+#   python benchmark_data_pipeline.py --baseline results.json --threshold 0.1
+
+import sys
+import json
+import time
+import argparse
+import resource
+import numpy as np
+from constants import Constants
+from augmentation import AddAndRemoveAPercentageOfNotes
+from data_generator import PianoRollGenerator
+from pianoroll_store import PackedPianoRollStore
+from utils.midi_utils import process_pianoroll
+
+timesteps_per_nbars = (Constants.bars * Constants.beats_per_bar *
+                       Constants.beat_resolution)
+time_steps_shifted_per_sample = (Constants.bars_shifted_per_sample *
+                                 Constants.beats_per_bar *
+                                 Constants.beat_resolution)
+sampling_bounds = {
+    'sampling_lower_bound_remove': 0,
+    'sampling_upper_bound_remove': 100,
+    'sampling_lower_bound_add': 1,
+    'sampling_upper_bound_add': 1.5
+}
+
+
+def generate_songs(number_of_songs, bars_per_song, density, seed):
+    '''Synthetic songs with on average @density of their cells set'''
+    random_state = np.random.RandomState(seed)
+    timesteps = bars_per_song * Constants.beats_per_bar * \
+        Constants.beat_resolution
+    return [
+        random_state.random_sample(
+            (timesteps, Constants.number_of_pitches)) < density
+        for _ in range(number_of_songs)
+    ]
+
+
+def time_stage(function, repeats):
+    '''Returns the best time in seconds of @repeats calls of @function'''
+    best = float('inf')
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def get_peak_rss_megabytes():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak_rss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def run_benchmarks(number_of_songs, bars_per_song, density, batch_size,
+                   repeats, seed):
+    songs = generate_songs(number_of_songs, bars_per_song, density, seed)
+    stages = {}
+
+    def process_all_songs():
+        for song in songs:
+            process_pianoroll(song, time_steps_shifted_per_sample,
+                              timesteps_per_nbars)
+
+    windows = [
+        window for song in songs for window in process_pianoroll(
+            song, time_steps_shifted_per_sample, timesteps_per_nbars)
+    ]
+    seconds = time_stage(process_all_songs, repeats)
+    stages['process_pianoroll'] = {
+        'seconds': seconds,
+        'windows_per_second': len(windows) / seconds
+    }
+
+    def pack_all_songs():
+        store = PackedPianoRollStore(timesteps_per_nbars,
+                                     Constants.number_of_pitches)
+        for song in songs:
+            store.add_pianoroll(song, time_steps_shifted_per_sample)
+        store.unpack_batch([0])
+
+    seconds = time_stage(pack_all_songs, repeats)
+    stages['pack_store'] = {
+        'seconds': seconds,
+        'windows_per_second': len(windows) / seconds
+    }
+
+    add_remove_notes = AddAndRemoveAPercentageOfNotes(**sampling_bounds)
+    number_of_samples = Constants.samples_per_ground_truth_data_item
+    seconds = time_stage(
+        lambda: add_remove_notes.sample(windows[0], number_of_samples),
+        repeats)
+    stages['augmentation_sample'] = {
+        'seconds': seconds,
+        'samples_per_second': number_of_samples / seconds
+    }
+
+    ground_truth = np.stack(windows[:batch_size])
+    seconds = time_stage(
+        lambda: add_remove_notes.sample_batch(ground_truth, 1), repeats)
+    stages['augmentation_sample_batch'] = {
+        'seconds': seconds,
+        'samples_per_second': len(ground_truth) / seconds
+    }
+
+    generator = PianoRollGenerator(
+        sample_list=windows,
+        batch_size=batch_size,
+        bars=Constants.bars,
+        samples_per_data_item=number_of_samples,
+        beat_resolution=Constants.beat_resolution,
+        number_of_pitches=Constants.number_of_pitches,
+        number_of_channels=Constants.number_of_channels,
+        beats_per_bar=Constants.beats_per_bar,
+        seed=seed,
+        **sampling_bounds)
+    number_of_batches = min(len(generator), 10)
+
+    def generate_batches():
+        for index in range(number_of_batches):
+            generator[index]
+
+    seconds = time_stage(generate_batches, repeats)
+    stages['generator_getitem'] = {
+        'seconds': seconds,
+        'batches_per_second': number_of_batches / seconds,
+        'samples_per_second': number_of_batches * batch_size / seconds
+    }
+
+    return {
+        'parameters': {
+            'number_of_songs': number_of_songs,
+            'bars_per_song': bars_per_song,
+            'density': density,
+            'batch_size': batch_size,
+            'repeats': repeats,
+            'seed': seed
+        },
+        'stages': stages,
+        'peak_rss_megabytes': get_peak_rss_megabytes()
+    }
+
+
+def compare_to_baseline(results, baseline, threshold):
+    '''
+    Returns a list of the throughputs that dropped by more than @threshold
+    (a fraction) compared to the baseline, or that are missing from the results.
+    Raises ValueError if the results were run with other parameters than the baseline.
+    '''
+    if results['parameters'] != baseline.get('parameters'):
+        raise ValueError(
+            "The results were run with parameters {} and the baseline with {}, "
+            "they cannot be compared.".format(results['parameters'],
+                                              baseline.get('parameters')))
+    regressions = []
+    for stage, metrics in baseline['stages'].items():
+        for metric, baseline_value in metrics.items():
+            if not metric.endswith('_per_second'):
+                continue
+            value = results['stages'].get(stage, {}).get(metric)
+            if value is None:
+                regressions.append("{}.{}: missing vs baseline {:.1f}".format(
+                    stage, metric, baseline_value))
+            elif value < baseline_value * (1 - threshold):
+                regressions.append(
+                    "{}.{}: {:.1f} vs baseline {:.1f}".format(
+                        stage, metric, value, baseline_value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the AR-CNN data pipeline")
+    parser.add_argument('--songs', type=int, default=100)
+    parser.add_argument('--bars-per-song', type=int, default=32)
+    parser.add_argument('--density', type=float, default=0.02,
+                        help="Fraction of pianoroll cells with a note")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Path to write the results JSON to")
+    parser.add_argument('--baseline',
+                        help="Path to a results JSON to compare to")
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help="Fail when a throughput drops by more than this fraction")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.songs, args.bars_per_song, args.density,
+                             args.batch_size, args.repeats, args.seed)
+    results_json = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(results_json)
+    print(results_json)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        try:
+            regressions = compare_to_baseline(results, baseline,
+                                              args.threshold)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        for regression in regressions:
+            print("Throughput regression: {}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
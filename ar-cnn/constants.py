@@ -32,6 +32,14 @@ class Constants():
     bars_shifted_per_sample = 4
     # Total number of pitches in a Pianoroll
     number_of_pitches = 128
+    # Lowest pitch of a Pianoroll. Pianorolls are cropped to the pitch window
+    # [lowest_pitch, lowest_pitch + number_of_pitches) for training and
+    # inference and padded back to all the midi pitches on output,
+    # e.g. lowest_pitch = 24 and number_of_pitches = 96 keeps pitches 24 to 119.
+    # number_of_pitches must be divisible by 2 ** the number of model layers.
+    lowest_pitch = 0
+    # Total number of midi pitches
+    number_of_midi_pitches = 128
     # Total number of Tracks
     number_of_channels = 1
     output_file_path = "outputs/output_{}.mid"
@@ -17,18 +17,56 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import traceback
+import os
+import json
+import math
+import hashlib
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 import keras
-from augmentation import AddAndRemoveAPercentageOfNotes
+from augmentation import AddAndRemoveAPercentageOfNotes, TransposeAndShiftNotes
+
+logger = logging.getLogger(__name__)
+
+# Generator used by the prefetch worker processes
+_worker_generator = None
+
+
+def _initialize_prefetch_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+
+def _generate_prefetched_training_pairs(index, epoch):
+    return _worker_generator.generate_training_pairs(index, epoch)
 
 
 class PianoRollGenerator(keras.utils.Sequence):
-    def __init__(self, sample_list, batch_size, bars, samples_per_data_item,
-                 beat_resolution, number_of_pitches, number_of_channels,
-                 beats_per_bar, sampling_lower_bound_remove,
-                 sampling_upper_bound_remove, sampling_lower_bound_add,
-                 sampling_upper_bound_add):
+    def __init__(self,
+                 sample_list,
+                 batch_size,
+                 bars,
+                 samples_per_data_item,
+                 beat_resolution,
+                 number_of_pitches,
+                 number_of_channels,
+                 beats_per_bar,
+                 sampling_lower_bound_remove,
+                 sampling_upper_bound_remove,
+                 sampling_lower_bound_add,
+                 sampling_upper_bound_add,
+                 shuffle=True,
+                 seed=None,
+                 prefetch_batches=0,
+                 prefetch_workers=1,
+                 prefetch_use_multiprocessing=False,
+                 batch_dtype=np.bool_,
+                 buffer_ring_size=0,
+                 max_pitch_transposition=0,
+                 max_time_shift=0):
 
         self.sample_list = sample_list
         self.batch_size = batch_size
@@ -36,66 +74,252 @@ class PianoRollGenerator(keras.utils.Sequence):
         self.number_of_pitches = number_of_pitches
         self.number_of_channels = number_of_channels
         self.samples_per_data_item = samples_per_data_item
-        self.sample_index = 0
         self.beat_resolution = beat_resolution
         self.beats_per_bar = beats_per_bar
         self.sampling_lower_bound_remove = sampling_lower_bound_remove
         self.sampling_upper_bound_remove = sampling_upper_bound_remove
         self.sampling_lower_bound_add = sampling_lower_bound_add
         self.sampling_upper_bound_add = sampling_upper_bound_add
+        self.add_remove_notes = AddAndRemoveAPercentageOfNotes(
+            sampling_lower_bound_remove=sampling_lower_bound_remove,
+            sampling_upper_bound_remove=sampling_upper_bound_remove,
+            sampling_lower_bound_add=sampling_lower_bound_add,
+            sampling_upper_bound_add=sampling_upper_bound_add)
+        # Randomly transpose and time shift the ground truth items in every batch
+        self.transpose_and_shift_notes = TransposeAndShiftNotes(
+            max_pitch_transposition=max_pitch_transposition,
+            max_time_shift=max_time_shift
+        ) if max_pitch_transposition or max_time_shift else None
+        # Visit the ground truth items in a new order every epoch
+        self.shuffle = shuffle
+        # Every batch is seeded from (seed, epoch, index), so any worker
+        # can build any batch and get the same result
+        self.seed = seed if seed is not None else np.random.randint(2**31)
+        self.epoch = 0
+        self.data_items_per_batch = math.ceil(batch_size /
+                                              samples_per_data_item)
+        self._permutation = None
+        # Number of batches to keep ready ahead of the requested one. Prefetching
+        # expects batches in index order, i.e. fit_generator(shuffle=False), the
+        # ground truth items are shuffled every epoch here anyway. It is turned
+        # off if batches are requested out of order, since the prefetched
+        # batches would be thrown away
+        self.prefetch_batches = prefetch_batches
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_use_multiprocessing = prefetch_use_multiprocessing
+        self._prefetch_executor = None
+        self._prefetched = {}
+        self._prefetch_misses = 0
+        self._prefetch_misses_epoch = None
+        self._prefetch_lock = threading.RLock()
+        # Compact dtype (bool or uint8) of the batches, Keras casts them
+        # to the model's float input when they are fed to the model
+        self.batch_dtype = batch_dtype
+        # Number of batches handed out before their (input, target) buffers
+        # are reused, 0 allocates new buffers for every batch. Must exceed the
+        # number of batches the consumer holds at once, e.g. max_queue_size +
+        # workers + 1 for fit_generator. Buffers of prefetched batches that are
+        # thrown away are reused as soon as they are done
+        self.buffer_ring_size = buffer_ring_size
+        self._free_buffers = []
+        self._handed_out_buffers = collections.deque()
+        self._scratch = threading.local()
+
+    def get_permutation(self, epoch):
+        '''Order in which the ground truth items are visited during @epoch'''
+        permutation = self._permutation
+        if permutation is None or permutation[0] != epoch:
+            if self.shuffle:
+                order = np.random.RandomState(
+                    [self.seed, epoch]).permutation(len(self.sample_list))
+            else:
+                order = np.arange(len(self.sample_list))
+            permutation = (epoch, order)
+            self._permutation = permutation
+        return permutation[1]
+
+    @property
+    def training_data_shape(self):
+        return (self.batch_size,
+                self.bars * self.beats_per_bar * self.beat_resolution,
+                self.number_of_pitches, self.number_of_channels)
+
+    def allocate_batch(self):
+        '''Allocates an (input, target) pair of batch buffers'''
+        return (np.empty(self.training_data_shape, dtype=self.batch_dtype),
+                np.empty(self.training_data_shape, dtype=self.batch_dtype))
+
+    def _get_scratch_buffer(self, name):
+        # Per thread scratch buffers the ground truth pianorolls are gathered in
+        buffer = getattr(self._scratch, name, None)
+        if buffer is None:
+            buffer = np.empty(self.training_data_shape[:3], dtype=np.bool_)
+            setattr(self._scratch, name, buffer)
+        return buffer
 
-    def generate_training_pairs(self):
+    def _acquire_buffers(self):
+        '''Buffers to write a batch into, None to allocate new ones'''
+        if not self.buffer_ring_size:
+            return None
+        with self._prefetch_lock:
+            if self._free_buffers:
+                return self._free_buffers.pop()
+        return self.allocate_batch()
+
+    def _release_buffers(self, buffers):
+        '''Makes buffers whose batch was never handed out reusable'''
+        if buffers is not None:
+            with self._prefetch_lock:
+                self._free_buffers.append(buffers)
+
+    def _hand_out(self, batch, buffers):
+        '''
+        Returns a batch to the consumer. Its buffers are only reused once
+        buffer_ring_size more batches have been handed out
         '''
-        Generates Training Pairs till @training_input / @training_target have @batch_size files.
+        if buffers is not None:
+            with self._prefetch_lock:
+                self._handed_out_buffers.append(buffers)
+                if len(self._handed_out_buffers) > self.buffer_ring_size:
+                    self._free_buffers.append(
+                        self._handed_out_buffers.popleft())
+        return batch
+
+    def _generate_into_buffers(self, index, epoch, buffers):
+        try:
+            return self.generate_training_pairs(index, epoch, buffers)
+        except BaseException:
+            self._release_buffers(buffers)
+            raise
+
+    def generate_training_pairs(self, index, epoch=None, out=None):
         '''
+        Generates the training pairs of batch @index, a fixed slice of the epoch's permutation.
+        The pairs are written to @out, an (input, target) pair of batch buffers, if given.
+        '''
+        if epoch is None:
+            epoch = self.epoch
+        if out is None:
+            out = self.allocate_batch()
+        permutation = self.get_permutation(epoch)
+        first_item = index * self.data_items_per_batch
+        # Ground truth item of each of the batch_size samples
+        sample_item_indices = permutation[
+            (first_item +
+             np.arange(self.batch_size) // self.samples_per_data_item) %
+            len(permutation)]
+        ground_truth = self._get_scratch_buffer('ground_truth')
+        random_state = np.random.RandomState([self.seed, epoch, index])
+        time_shifts = None
+        if hasattr(self.sample_list, 'unpack_batch'):
+            if self.transpose_and_shift_notes is not None:
+                # Stores hold whole songs, so windows are time shifted by
+                # moving their start within the song
+                time_shifts = self.transpose_and_shift_notes.get_time_shifts(
+                    self.batch_size, random_state)
+            self.sample_list.unpack_batch(sample_item_indices,
+                                          out=ground_truth,
+                                          time_shifts=time_shifts)
+        else:
+            for sample_index, item_index in enumerate(sample_item_indices):
+                ground_truth[sample_index] = self.sample_list[item_index]
+
+        if self.transpose_and_shift_notes is not None and (
+                time_shifts is None
+                or self.transpose_and_shift_notes.max_pitch_transposition):
+            ground_truth = self.transpose_and_shift_notes.apply_to_batch(
+                ground_truth,
+                random_state=random_state,
+                out=self._get_scratch_buffer('transposed_ground_truth'),
+                time_shifts=None if time_shifts is None else np.zeros_like(
+                    time_shifts))
+
+        # For each pianoroll section, add or remove certain percentage of notes
+        return self.add_remove_notes.sample_batch(ground_truth,
+                                                  1,
+                                                  random_state=random_state,
+                                                  out=out)
+
+    def _get_prefetch_executor(self):
+        if self._prefetch_executor is None:
+            if self.prefetch_use_multiprocessing:
+                # The generator is sent to every worker once, not per batch
+                self._prefetch_executor = ProcessPoolExecutor(
+                    self.prefetch_workers,
+                    initializer=_initialize_prefetch_worker,
+                    initargs=(self, ))
+            else:
+                self._prefetch_executor = ThreadPoolExecutor(
+                    self.prefetch_workers)
+        return self._prefetch_executor
 
-        # Create the training and target lists
-        training_input = []
-        training_target = []
-        while len(training_input) <= self.batch_size:
-            target_pianoroll = self.sample_list[self.sample_index]
-            self.sample_index = (self.sample_index + 1) % len(self.sample_list)
-            try:
-                training_data_shape = (self.bars * self.beats_per_bar *
-                                       self.beat_resolution,
-                                       self.number_of_pitches,
-                                       self.number_of_channels)
-
-                # For each pianoroll section, add or remove certain percentage of notes
-                add_remove_notes = AddAndRemoveAPercentageOfNotes(
-                    sampling_lower_bound_remove=self.
-                    sampling_lower_bound_remove,
-                    sampling_upper_bound_remove=self.
-                    sampling_upper_bound_remove,
-                    sampling_lower_bound_add=self.sampling_lower_bound_add,
-                    sampling_upper_bound_add=self.sampling_upper_bound_add)
-
-                input_pianorolls = add_remove_notes.sample(
-                    target_pianoroll, self.samples_per_data_item)
-
-                for input_pianoroll in input_pianorolls:
-                    training_input.append(
-                        input_pianoroll.reshape(training_data_shape))
-                    xor_target = np.logical_xor(input_pianoroll,
-                                                target_pianoroll)
-                    training_target.append(
-                        xor_target.reshape(training_data_shape))
-
-                if len(training_input) >= self.batch_size:
-                    training_input = np.asarray(
-                        training_input[:self.batch_size])
-                    training_target = np.asarray(
-                        training_target[:self.batch_size])
-                    return training_input, training_target
-
-            except Exception as e:
-                print('Error generating input and target pair')
-                traceback.print_exc()
+    def _submit(self, index, epoch):
+        ''':return: future of the batch, buffers it is written to'''
+        if self.prefetch_use_multiprocessing:
+            return self._get_prefetch_executor().submit(
+                _generate_prefetched_training_pairs, index, epoch), None
+        buffers = self._acquire_buffers()
+        return self._get_prefetch_executor().submit(
+            self._generate_into_buffers, index, epoch, buffers), buffers
+
+    def _drop_prefetched(self, key):
+        '''Cancels a prefetched batch, its buffers are reused once it is done'''
+        future, buffers = self._prefetched.pop(key)
+        future.cancel()
+        if buffers is not None:
+            future.add_done_callback(
+                lambda future: (future.cancelled() or future.exception() is None)
+                and self._release_buffers(buffers))
+
+    def _count_prefetch_miss(self, epoch):
+        '''
+        Counts a batch that was not prefetched, and turns prefetching off when
+        batches are clearly requested out of order
+        '''
+        if self._prefetch_misses_epoch != epoch:
+            self._prefetch_misses_epoch = epoch
+            self._prefetch_misses = 0
+        self._prefetch_misses += 1
+        # Concurrent in order requests can miss up to prefetch_batches batches
+        if self._prefetch_misses > self.prefetch_batches + 1:
+            logger.warning(
+                "Batches are requested out of order, e.g. by "
+                "fit_generator(shuffle=True), turning prefetching off. Pass "
+                "shuffle=False to prefetch, the generator shuffles every epoch.")
+            self.prefetch_batches = 0
+            for key in list(self._prefetched):
+                self._drop_prefetched(key)
 
     def __getitem__(self, index):
         '''Generates 1 batch of data'''
-        training_input, training_target = self.generate_training_pairs()
-        return training_input, training_target
+        if not self.prefetch_batches:
+            buffers = self._acquire_buffers()
+            return self._hand_out(
+                self._generate_into_buffers(index, self.epoch, buffers),
+                buffers)
+
+        epoch = self.epoch
+        with self._prefetch_lock:
+            prefetched = self._prefetched.pop((epoch, index), None)
+            if prefetched is None:
+                if index != 0:
+                    self._count_prefetch_miss(epoch)
+                prefetched = self._submit(index, epoch)
+            future, buffers = prefetched
+            # Drop batches that will not be requested anymore, leaving
+            # some slack for concurrent requests that arrive out of order
+            for key in list(self._prefetched):
+                if key[0] != epoch or key[1] < index - self.prefetch_batches:
+                    self._drop_prefetched(key)
+            # Keep a bounded number of upcoming batches in flight
+            for next_index in range(
+                    index + 1,
+                    min(index + 1 + self.prefetch_batches, len(self))):
+                if (epoch, next_index) not in self._prefetched:
+                    self._prefetched[(epoch,
+                                      next_index)] = self._submit(
+                                          next_index, epoch)
+        return self._hand_out(future.result(), buffers)
 
     def __len__(self):
         '''Number of batches / epoch'''
@@ -103,3 +327,124 @@ class PianoRollGenerator(keras.utils.Sequence):
             (len(self.sample_list) * self.samples_per_data_item) /
             self.batch_size)
         return samples_to_generate
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def close(self):
+        '''Shuts down the prefetch workers'''
+        with self._prefetch_lock:
+            for key in list(self._prefetched):
+                self._drop_prefetched(key)
+            if self._prefetch_executor is not None:
+                self._prefetch_executor.shutdown(wait=False)
+                self._prefetch_executor = None
+
+    def __getstate__(self):
+        # Workers get a copy without the prefetch machinery
+        state = self.__dict__.copy()
+        state['_prefetch_executor'] = None
+        state['_prefetched'] = {}
+        state['_prefetch_lock'] = None
+        state['_free_buffers'] = []
+        state['_handed_out_buffers'] = collections.deque()
+        state['_scratch'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._prefetch_lock = threading.RLock()
+        self._scratch = threading.local()
+
+
+class FrozenPianoRollGenerator(keras.utils.Sequence):
+    '''
+    Serves the batches of the first epoch of a PianoRollGenerator, e.g. the
+    validation generator, so that every epoch sees the same batches.
+    The batches are generated once and stored bit-packed along the pitch axis
+    in a .npy file that is memory-mapped by later epochs and later runs.
+    Create the PianoRollGenerator with a fixed seed to reuse the file across runs.
+    '''
+    def __init__(self, generator, cache_path):
+        self.generator = generator
+        self.cache_path = cache_path
+        self.metadata_path = cache_path + '.json'
+        metadata = self.get_metadata()
+        if not self._is_cache_valid(metadata):
+            self._write_cache(metadata)
+        self.packed_batches = np.load(cache_path, mmap_mode='r')
+
+    def get_metadata(self):
+        '''Everything the frozen batches depend on'''
+        generator = self.generator
+        if hasattr(generator.sample_list, 'get_fingerprint'):
+            # Stores hash their packed data without unpacking every window
+            fingerprint = generator.sample_list.get_fingerprint()
+        else:
+            fingerprint = hashlib.sha1()
+            for sample in generator.sample_list:
+                fingerprint.update(np.packbits(sample, axis=-1).tobytes())
+            fingerprint = fingerprint.hexdigest()
+        return {
+            'fingerprint': fingerprint,
+            'seed': int(generator.seed),
+            'shuffle': generator.shuffle,
+            'training_data_shape': list(generator.training_data_shape),
+            'samples_per_data_item': generator.samples_per_data_item,
+            'number_of_batches': len(generator),
+            'sampling_bounds': [
+                generator.sampling_lower_bound_remove,
+                generator.sampling_upper_bound_remove,
+                generator.sampling_lower_bound_add,
+                generator.sampling_upper_bound_add
+            ],
+            'max_pitch_transposition': getattr(
+                generator.transpose_and_shift_notes,
+                'max_pitch_transposition', 0),
+            'max_time_shift': getattr(generator.transpose_and_shift_notes,
+                                      'max_time_shift', 0)
+        }
+
+    def _is_cache_valid(self, metadata):
+        if not (os.path.isfile(self.cache_path)
+                and os.path.isfile(self.metadata_path)):
+            return False
+        with open(self.metadata_path) as metadata_file:
+            return json.load(metadata_file) == metadata
+
+    def _write_cache(self, metadata):
+        batch_size, timesteps, pitches, _ = self.generator.training_data_shape
+        temporary_path = self.cache_path + '.tmp.npy'
+        # (batch index, input / target, sample, timestep, packed pitches)
+        packed_batches = np.lib.format.open_memmap(
+            temporary_path,
+            mode='w+',
+            dtype=np.uint8,
+            shape=(len(self.generator), 2, batch_size, timesteps,
+                   -(-pitches // 8)))
+        out = (np.empty((batch_size, timesteps, pitches), dtype=np.bool_),
+               np.empty((batch_size, timesteps, pitches), dtype=np.bool_))
+        for index in range(len(self.generator)):
+            training_input, training_target = \
+                self.generator.generate_training_pairs(index, epoch=0,
+                                                       out=out)
+            packed_batches[index, 0] = np.packbits(training_input, axis=-1)
+            packed_batches[index, 1] = np.packbits(training_target, axis=-1)
+        packed_batches.flush()
+        del packed_batches
+        os.replace(temporary_path, self.cache_path)
+        with open(self.metadata_path, 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+
+    def __getitem__(self, index):
+        '''Unpacks 1 frozen batch of data'''
+        training_data_shape = self.generator.training_data_shape
+        batch = np.unpackbits(self.packed_batches[index],
+                              axis=-1)[..., :training_data_shape[2]]
+        batch = batch.astype(self.generator.batch_dtype, copy=False)
+        return (batch[0].reshape(training_data_shape),
+                batch[1].reshape(training_data_shape))
+
+    def __len__(self):
+        '''Number of batches / epoch'''
+        return len(self.packed_batches)
@@ -0,0 +1,222 @@
+# The MIT-Zero License
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Trains a small student AR-CNN to match the logits of a trained teacher,
+# and compares the latency and music metrics of the two.
+# Training, e.g. from the notebook:
+#   student = ArCnnModel(input_dim, num_filters=8, growth_factor=2, num_layers=3, ...)
+#   student_model, history = distill(teacher_model, student,
+#                                    training_data_generator,
+#                                    validation_data_generator, epochs=10)
+# Report:
+#   python distillation.py --teacher checkpoints/teacher.hdf5 \
+#       --student checkpoints/student.hdf5 --inputs sample_inputs
+
+import os
+import json
+import argparse
+import tempfile
+import numpy as np
+import keras
+from texttable import Texttable
+from constants import Constants
+from losses import Loss
+from model import ArCnnModel
+from inference import Inference, SamplingMetricsRecorder
+from utils.midi_utils import compute_music_metrics
+
+
+class DistillationGenerator(keras.utils.Sequence):
+    '''
+    Adds the logits of a teacher model to the batches of a PianoRollGenerator
+    or FrozenPianoRollGenerator. The targets get a second channel with the
+    teacher logits of the inputs, see Loss.distillation_kl_loss.
+    '''
+    def __init__(self, generator, teacher_model):
+        self.generator = generator
+        self.teacher_model = teacher_model
+        # The teacher runs in the data loading thread of fit_generator, which
+        # needs the predict function of graph mode backends built beforehand
+        if hasattr(teacher_model, '_make_predict_function'):
+            teacher_model._make_predict_function()
+
+    def __getitem__(self, index):
+        '''Generates 1 batch of data with the teacher logits'''
+        training_input, training_target = self.generator[index]
+        teacher_logits = self.teacher_model.predict(training_input)
+        return training_input, np.concatenate(
+            [training_target.astype(np.float32),
+             teacher_logits.astype(np.float32)],
+            axis=-1)
+
+    def __len__(self):
+        '''Number of batches / epoch'''
+        return len(self.generator)
+
+    def on_epoch_end(self):
+        self.generator.on_epoch_end()
+
+
+def distill(teacher_model,
+            student,
+            training_generator,
+            validation_generator=None,
+            epochs=1,
+            temperature=1.0,
+            ground_truth_weight=0.0,
+            callbacks=None):
+    '''
+    Trains a student model on the logits of a teacher model
+    :param teacher_model: trained keras model
+    :param student: ArCnnModel of the student, e.g. fewer layers and filters or separable convolutions
+    :param training_generator: PianoRollGenerator of the training inputs
+    :param validation_generator: PianoRollGenerator of the validation inputs
+    :param epochs: number of epochs to train for
+    :param temperature: temperature of the teacher and student softmax, see Loss.distillation_kl_loss
+    :param ground_truth_weight: weight of the ground truth loss, see Loss.distillation_kl_loss
+    :param callbacks: keras callbacks, e.g. a ModelCheckpoint of the student
+    :return: student model, training history
+    '''
+    student_model = student.build_model(compile_model=False)
+    optimizer = student.get_optimizer(student.optimizer_enum,
+                                      student.learning_rate)
+    student_model.compile(optimizer=optimizer,
+                          loss=Loss.distillation_kl_loss(
+                              temperature, ground_truth_weight))
+    ArCnnModel.print_cost_report(student_model)
+    history = student_model.fit_generator(
+        DistillationGenerator(training_generator, teacher_model),
+        validation_data=None if validation_generator is None else
+        DistillationGenerator(validation_generator, teacher_model),
+        epochs=epochs,
+        callbacks=callbacks)
+    return student_model, history
+
+
+def compare_to_teacher(teacher_inference, student_inference, input_midi_paths,
+                       inference_params, seed=0):
+    '''
+    Samples a composition of every input with the teacher and the student
+    :param teacher_inference: Inference with the teacher model
+    :param student_inference: Inference with the student model
+    :param input_midi_paths: paths of the input midi files
+    :param inference_params: JSON with inference parameters
+    :param seed: random seed of the compositions
+    :return: list of dict with the per-iteration latency and the music
+    metrics of the teacher and student composition of every input
+    '''
+    results = []
+    with tempfile.TemporaryDirectory() as output_directory:
+        for input_midi_path in input_midi_paths:
+            input_tensor = teacher_inference.convert_midi_to_tensor(
+                input_midi_path)
+            result = {'input': os.path.basename(input_midi_path)}
+            for name, inference in (('teacher', teacher_inference),
+                                    ('student', student_inference)):
+                recorder = SamplingMetricsRecorder()
+                output_tensor = inference.sample_multiple_batch(
+                    input_tensor,
+                    inference_params['temperature'],
+                    inference_params['maxPercentageOfInitialNotesRemoved'],
+                    inference_params['maxNotesAdded'],
+                    inference_params['samplingIterations'], [seed],
+                    inference_params.get('notesPerIteration', 1),
+                    callback=recorder)[0]
+                summary = recorder.summary()
+                output_midi_path = os.path.join(output_directory,
+                                                name + '.mid')
+                with open(output_midi_path, 'wb') as output_midi:
+                    output_midi.write(
+                        inference.convert_tensor_to_midi_bytes(
+                            output_tensor, Constants.tempo))
+                result[name] = {
+                    'seconds_per_iteration':
+                    (summary['forward_pass_seconds'] +
+                     summary['sampling_seconds']) /
+                    max(summary['iterations'], 1),
+                    'metrics': {
+                        metric: float(value)
+                        for metric, value in compute_music_metrics(
+                            output_midi_path,
+                            Constants.beat_resolution).items()
+                    }
+                }
+            results.append(result)
+    return results
+
+
+def print_comparison(results):
+    '''Prints the results of compare_to_teacher'''
+    metric_names = list(results[0]['teacher']['metrics'])
+    table = Texttable()
+    rows = [["input", "model", "ms / iteration"] + metric_names]
+    for result in results:
+        for name in ('teacher', 'student'):
+            rows.append(
+                [result['input'], name,
+                 1000 * result[name]['seconds_per_iteration']] +
+                [result[name]['metrics'][metric] for metric in metric_names])
+    table.add_rows(rows)
+    print(table.draw())
+    print("Mean per-iteration speedup of the student: {:.2f}x".format(
+        np.mean([
+            result['teacher']['seconds_per_iteration'] /
+            result['student']['seconds_per_iteration'] for result in results
+        ])))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares a distilled AR-CNN student to its teacher")
+    parser.add_argument('--teacher', required=True,
+                        help="Path to the teacher model")
+    parser.add_argument('--student', required=True,
+                        help="Path to the student model")
+    parser.add_argument('--inputs', default='sample_inputs',
+                        help="Directory of midi files to compare on")
+    parser.add_argument('--inference-params',
+                        default='inference_parameters.json')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Path to write the results JSON to")
+    args = parser.parse_args()
+
+    with open(args.inference_params) as json_file:
+        inference_params = json.load(json_file)
+    teacher_inference = Inference()
+    teacher_inference.load_model(args.teacher)
+    student_inference = Inference()
+    student_inference.load_model(args.student)
+    input_midi_paths = sorted(
+        os.path.join(args.inputs, file_name)
+        for file_name in os.listdir(args.inputs)
+        if file_name.endswith(('.mid', '.midi')))
+    for inference in (teacher_inference, student_inference):
+        inference.warmup()
+
+    results = compare_to_teacher(teacher_inference, student_inference,
+                                 input_midi_paths, inference_params,
+                                 args.seed)
+    print_comparison(results)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
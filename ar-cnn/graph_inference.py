@@ -0,0 +1,187 @@
+# The MIT-Zero License
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+import numpy as np
+import tensorflow as tf
+from constants import Constants
+from inference import Inference
+
+
+class GraphInference(Inference):
+    """
+    Inference engine that compiles the whole sampling loop (model call,
+    temperature, masking, categorical sampling, note budgets and tensor
+    update) into one TensorFlow graph with tf.function and tf.while_loop,
+    instead of a Python loop around model.predict. Requires TensorFlow 2.
+    Takes the same inference_params and returns the same outputs as Inference.
+    """
+    def __init__(self, model=None, cache=None):
+        super().__init__(model, cache)
+        self._sampling_loop = None
+        self._sampling_loop_model = None
+
+    def _get_sampling_loop(self):
+        """
+        Returns the compiled sampling loop of the current model, tracing it
+        on first use. The batch size is left dynamic so that it is traced once.
+        """
+        if (self._sampling_loop is not None
+                and self._sampling_loop_model is self.model):
+            return self._sampling_loop
+        model = self.model
+        number_of_cells = (self.number_of_timesteps *
+                           Constants.number_of_pitches)
+        model_input_shape = (-1, self.number_of_timesteps,
+                             Constants.number_of_pitches, 1)
+
+        @tf.function(input_signature=[
+            tf.TensorSpec((None, ) + model_input_shape[1:], tf.bool),
+            tf.TensorSpec((None, ), tf.float32),
+            tf.TensorSpec((None, ), tf.int32),
+            tf.TensorSpec((), tf.int32),
+            tf.TensorSpec((), tf.int32),
+            tf.TensorSpec((2, ), tf.int32)
+        ])
+        def sampling_loop(input_tensor, temperatures,
+                          max_original_notes_to_remove, max_notes_to_add,
+                          number_of_iterations, seed):
+            batch_size = tf.shape(input_tensor)[0]
+            original_input = tf.reshape(input_tensor, (batch_size, -1))
+
+            def body(iteration, current_input, moves_possible):
+                # Original notes currently removed and new notes currently added
+                current_removed = original_input & ~current_input
+                current_added = ~original_input & current_input
+                notes_removed_count = tf.reduce_sum(
+                    tf.cast(current_removed, tf.int32), axis=1)
+                notes_added_count = tf.reduce_sum(
+                    tf.cast(current_added, tf.int32), axis=1)
+
+                logits = model(tf.reshape(tf.cast(current_input, tf.float32),
+                                          model_input_shape),
+                               training=False)
+                logits = tf.reshape(logits, (batch_size, number_of_cells))
+                logits = logits / temperatures[:, tf.newaxis]
+
+                # Mask all pixels that both have a note and were once part of the original input
+                removal_blocked = (notes_removed_count >=
+                                   max_original_notes_to_remove)
+                # Mask all pixels that both do not have a note and were not once part of the original input
+                addition_blocked = notes_added_count > max_notes_to_add
+                not_allowed_notes = (
+                    (removal_blocked[:, tf.newaxis] & original_input
+                     & current_input) |
+                    (addition_blocked[:, tf.newaxis] & ~original_input
+                     & ~current_input))
+                logits = tf.where(not_allowed_notes,
+                                  tf.constant(-np.inf, logits.dtype), logits)
+                # Samples with every note masked, or with both budgets used
+                # up, are left unchanged, see Inference.sample_notes_from_model
+                any_allowed = (tf.reduce_any(~not_allowed_notes, axis=1)
+                               & ~(removal_blocked & addition_blocked))
+
+                sampled_indices = tf.random.stateless_categorical(
+                    logits, 1, seed=seed + tf.stack([0, iteration]))[:, 0]
+                flipped = tf.one_hot(sampled_indices,
+                                     number_of_cells,
+                                     on_value=True,
+                                     off_value=False,
+                                     dtype=tf.bool)
+                flipped &= any_allowed[:, tf.newaxis]
+                return iteration + 1, tf.math.logical_xor(
+                    current_input, flipped), tf.reduce_any(any_allowed)
+
+            # Stop early once no sample can change anymore or every sample
+            # has used up its note budgets
+            _, output, _ = tf.while_loop(
+                lambda iteration, _, moves_possible:
+                (iteration < number_of_iterations) & moves_possible, body,
+                (tf.constant(0), original_input, tf.constant(True)))
+            return tf.reshape(output, tf.shape(input_tensor)[:3])
+
+        self._sampling_loop = sampling_loop
+        self._sampling_loop_model = model
+        return sampling_loop
+
+    def warmup(self, batch_sizes=(1, )):
+        """
+        Same as Inference.warmup, tracing and running the sampling loop
+        instead of model.predict
+        """
+        if not callable(self.model):
+            return super().warmup(batch_sizes)
+        start_time = time.perf_counter()
+        sampling_loop = self._get_sampling_loop()
+        for batch_size in batch_sizes:
+            sampling_loop(
+                tf.zeros((batch_size, self.number_of_timesteps,
+                          Constants.number_of_pitches, 1), tf.bool),
+                tf.ones((batch_size, )), tf.zeros((batch_size, ), tf.int32),
+                tf.constant(0), tf.constant(1), tf.zeros((2, ), tf.int32))
+        self.load_timings['warmup_seconds'] = time.perf_counter() - start_time
+        return dict(self.load_timings)
+
+    def sample_multiple_batch(self,
+                              input_tensor,
+                              temperatures,
+                              max_removal_percentage,
+                              max_notes_to_add,
+                              number_of_iterations,
+                              seeds=None,
+                              num_notes=1,
+                              callback=None,
+                              editable_notes=None,
+                              max_notes_to_remove=None):
+        """
+        Same as Inference.sample_multiple_batch, with the sampling loop run as one graph.
+        Schedules of several notes per forward pass, per iteration callbacks and
+        editable note masks or budgets per sample, e.g. from sample_long_input,
+        and models that cannot run in a graph, e.g. a QuantizedModel,
+        fall back to the NumPy sampler.
+        Seeds make the whole batch reproducible rather than each sample.
+        """
+        if (callable(num_notes) or num_notes != 1 or callback is not None
+                or editable_notes is not None
+                or max_notes_to_remove is not None
+                or np.ndim(max_notes_to_add) != 0 or not callable(self.model)):
+            return super().sample_multiple_batch(
+                input_tensor, temperatures, max_removal_percentage,
+                max_notes_to_add, number_of_iterations, seeds, num_notes,
+                callback, editable_notes, max_notes_to_remove)
+
+        input_tensor = input_tensor.astype(np.bool_)
+        batch_size = len(input_tensor)
+        max_original_notes_to_remove = (
+            max_removal_percentage *
+            np.count_nonzero(input_tensor.reshape(batch_size, -1), axis=1) /
+            100).astype(np.int32)
+        temperatures = np.broadcast_to(
+            np.asarray(temperatures, dtype=np.float32), (batch_size, ))
+        if seeds is None:
+            seed = np.random.randint(2**31, size=2)
+        else:
+            seed = np.random.SeedSequence(list(seeds)).generate_state(2) >> 1
+        output_tensor = self._get_sampling_loop()(
+            tf.constant(input_tensor), tf.constant(temperatures),
+            tf.constant(max_original_notes_to_remove),
+            tf.constant(max_notes_to_add, dtype=tf.int32),
+            tf.constant(number_of_iterations, dtype=tf.int32),
+            tf.constant(seed.astype(np.int32)))
+        return output_tensor.numpy()
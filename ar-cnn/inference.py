@@ -17,23 +17,85 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import io
 import os
+import json
+import errno
+import time
 import logging
+import hashlib
+import uuid
+import threading
 import pypianoroll
 import keras
 import numpy as np
 from losses import Loss
+from model import ArCnnModel
+from quantization import QuantizedModel
 from constants import Constants
-import copy
+from utils.midi_utils import crop_pitches, pad_pitches
 
 logger = logging.getLogger(__name__)
 
+# Next index to try for each output file path, see convert_tensor_to_midi
+_next_output_file_index = {}
+_output_file_index_lock = threading.Lock()
+# os.link errors of file systems without hard links
+_link_not_supported_errnos = {
+    errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS
+}
+
+
+def _get_next_index_file_path(output_file_path):
+    directory, file_name = os.path.split(output_file_path)
+    return os.path.join(directory,
+                        '.{}.next_index'.format(file_name.replace('{}', 'N')))
+
+
+def _read_next_output_file_index(output_file_path):
+    """
+    Next index to try for an output file path, persisted by earlier processes
+    so that a new process does not check every existing output again.
+    It is only a hint, publishing an output never overwrites one.
+    """
+    try:
+        with open(_get_next_index_file_path(output_file_path)) as index_file:
+            return max(int(index_file.read()), 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def _write_next_output_file_index(output_file_path, next_index):
+    next_index_file_path = _get_next_index_file_path(output_file_path)
+    temporary_file_path = '{}.{}-{}'.format(next_index_file_path, os.getpid(),
+                                            uuid.uuid4().hex)
+    try:
+        with open(temporary_file_path, 'w') as index_file:
+            index_file.write(str(next_index))
+        os.replace(temporary_file_path, next_index_file_path)
+    except OSError:
+        logger.warning("Unable to save the next output file index.",
+                       exc_info=True)
+
 
 class Inference:
-    def __init__(self, model=None):
+    def __init__(self, model=None, cache=None):
+        """
+        Parameters
+        ----------
+        model : keras model, optional
+            trained model, see load_model
+        cache : InferenceCache, optional
+            cache of parsed inputs and of the outputs of seeded requests
+        """
         self.model = model
+        self.cache = cache
         self.number_of_timesteps = (Constants.beat_resolution *
                                     Constants.beats_per_bar * Constants.bars)
+        # Cold start breakdown, see load_model and warmup
+        self.load_timings = {}
+        self._model_hash = None
+        self._model_hash_model = None
 
     def load_model(self, model_path):
         """
@@ -42,105 +104,324 @@ class Inference:
         Parameters
         ----------
         model_path : string
-            Full file path to the trained model
+            Full file path to the trained model, a serving model directory
+            written by ArCnnModel.export_for_serving, which loads faster, or
+            an int8 .tflite model written by quantization.export_quantized_model,
+            which runs faster on CPU
 
         Returns
         -------
         None
         """
+        if os.path.isdir(model_path):
+            self.load_serving_model(model_path)
+            return
+        if model_path.endswith('.tflite'):
+            start_time = time.perf_counter()
+            self.model = QuantizedModel(model_path)
+            self.load_timings = {
+                'load_seconds': time.perf_counter() - start_time
+            }
+            logger.info("Loaded the quantized model in {:.3f}s.".format(
+                self.load_timings['load_seconds']))
+            return
+        start_time = time.perf_counter()
         self.model = keras.models.load_model(model_path,
                                              custom_objects={
                                                  'built_in_softmax_kl_loss':
                                                  Loss.built_in_softmax_kl_loss
                                              },
                                              compile=False)
+        self.load_timings = {'load_seconds': time.perf_counter() - start_time}
+        logger.info("Loaded the model in {:.3f}s.".format(
+            self.load_timings['load_seconds']))
+
+    def load_serving_model(self, serving_dir):
+        """
+        Rebuilds the architecture from its hyper-parameters and loads only its
+        weights, without the optimizer state and compilation of a full checkpoint
+
+        Parameters
+        ----------
+        serving_dir : string
+            directory written by ArCnnModel.export_for_serving
+
+        Returns
+        -------
+        None
+        """
+        start_time = time.perf_counter()
+        with open(
+                os.path.join(serving_dir,
+                             ArCnnModel.SERVING_CONFIG_FILE_NAME)) as config_file:
+            config = json.load(config_file)
+        model = ArCnnModel.from_config(config).build_model(compile_model=False)
+        build_time = time.perf_counter() - start_time
+        model.load_weights(
+            os.path.join(serving_dir, ArCnnModel.SERVING_WEIGHTS_FILE_NAME))
+        self.model = model
+        self.load_timings = {
+            'build_seconds': build_time,
+            'load_seconds': time.perf_counter() - start_time - build_time
+        }
+        logger.info("Built the model in {:.3f}s and loaded its weights in "
+                    "{:.3f}s.".format(self.load_timings['build_seconds'],
+                                      self.load_timings['load_seconds']))
+
+    def warmup(self, batch_sizes=(1, )):
+        """
+        Runs the model once per batch size, so that graph building and
+        memory allocation are not paid by the first requests
+
+        Parameters
+        ----------
+        batch_sizes : list of int
+            batch sizes the model will be run with, e.g. 1 and the largest batch
+
+        Returns
+        -------
+        dict
+            load, build and warm-up seconds of the model, see load_timings
+        """
+        start_time = time.perf_counter()
+        for batch_size in batch_sizes:
+            # Same dtype as the sampler inputs, see sample_notes_from_model
+            self.model.predict(
+                np.zeros((batch_size, self.number_of_timesteps,
+                          Constants.number_of_pitches, 1),
+                         dtype=np.bool_))
+        self.load_timings['warmup_seconds'] = time.perf_counter() - start_time
+        logger.info("Warmed up the model in {:.3f}s.".format(
+            self.load_timings['warmup_seconds']))
+        return dict(self.load_timings)
+
+    def get_model_hash(self):
+        """
+        Hashes the weights of the model, computed once per loaded model.
+        Weights changed in place, e.g. by further training, are not noticed.
+
+        Returns
+        -------
+        str
+            hexadecimal sha1 of the model weights
+        """
+        if self._model_hash is None or self._model_hash_model is not self.model:
+            model_hash = hashlib.sha1()
+            for weights in self.model.get_weights():
+                model_hash.update(str(weights.shape).encode())
+                model_hash.update(np.ascontiguousarray(weights).tobytes())
+            self._model_hash = model_hash.hexdigest()
+            self._model_hash_model = self.model
+        return self._model_hash
+
+    def get_output_cache_key(self, input_midi_bytes, inference_params, seed,
+                             kind):
+        """
+        Cache key of the output of a seeded request
+
+        Parameters
+        ----------
+        input_midi_bytes : bytes
+            contents of the input midi
+        inference_params : json
+            JSON with inference parameters
+        seed : int
+            random seed of the request
+        kind : str
+            kind of output, e.g. the name of the generating method
+
+        Returns
+        -------
+        str
+            key of the output in self.cache
+        """
+        return self.cache.get_key(
+            kind, input_midi_bytes, self.get_model_hash(),
+            json.dumps(inference_params, sort_keys=True), str(seed),
+            type(self).__name__)
 
     @staticmethod
-    def convert_tensor_to_midi(tensor, tempo, output_file_path):
+    def read_midi_bytes(input_midi):
         """
-        Writes a pianoroll tensor to a midi file
+        Reads the contents of a midi
+
+        Parameters
+        ----------
+        input_midi : string, bytes or file-like object
+            Full file path to the input midi, or its contents
+
+        Returns
+        -------
+        bytes
+            midi file contents
+        """
+        if isinstance(input_midi, (bytes, bytearray)):
+            return bytes(input_midi)
+        if isinstance(input_midi, (str, os.PathLike)):
+            with open(input_midi, 'rb') as midi_file:
+                return midi_file.read()
+        return input_midi.read()
+
+    @staticmethod
+    def convert_tensor_to_midi_bytes(tensor, tempo):
+        """
+        Converts a pianoroll tensor to the contents of a midi file
 
         Parameters
         ----------
         tensor : 2d numpy array
-            pianoroll to be converted to a midi
+            pianoroll to be converted to a midi, with every midi pitch or
+            cropped to the pitch window of the model
         tempo : float
             tempo to output
-        output_file_path : str
-            output midi file path
 
         Returns
         -------
-        None
+        bytes
+            midi file contents
         """
 
+        if tensor.shape[1] != Constants.number_of_midi_pitches:
+            # Pad the pitch window of the model back to every midi pitch
+            tensor = pad_pitches(tensor, Constants.lowest_pitch)
         single_track = pypianoroll.Track(pianoroll=tensor)
         multi_track = pypianoroll.Multitrack(
             tracks=[single_track],
             tempo=tempo,
             beat_resolution=Constants.beat_resolution)
-        output_file_index = 0
-        while os.path.isfile(output_file_path.format(output_file_index)):
-            output_file_index += 1
-        multi_track.write(output_file_path.format(output_file_index))
+        midi_file = io.BytesIO()
+        multi_track.to_pretty_midi().write(midi_file)
+        return midi_file.getvalue()
 
     @staticmethod
-    def get_indices(input_tensor, value):
+    def convert_tensor_to_midi(tensor, tempo, output_file_path):
         """
+        Writes a pianoroll tensor to a midi file
+
         Parameters
         ----------
-        input_tensor : 2d numpy array
-        value : int (either 1 or 0)
+        tensor : 2d numpy array
+            pianoroll to be converted to a midi
+        tempo : float
+            tempo to output
+        output_file_path : str
+            output midi file path, with {} replaced by the first free index
 
         Returns
         -------
-        indices_with_value : 2d array of indices in the input_tensor where the pixel value equals value (1 or 0).
+        str
+            path of the written midi file
         """
-        indices_with_value = np.argwhere(input_tensor.astype(np.bool_) == value)
-        return set(map(tuple, indices_with_value))
+
+        midi_bytes = Inference.convert_tensor_to_midi_bytes(tensor, tempo)
+        output_directory = os.path.dirname(output_file_path) or '.'
+        # Write the midi to a temporary file and publish it with os.link, which
+        # fails instead of overwriting when the name was taken meanwhile, e.g.
+        # by a concurrent worker. Readers never see a partially written midi.
+        # Created like open does, so the umask gives it the usual permissions
+        temporary_file_path = os.path.join(
+            output_directory, '.tmp-{}-{}.mid'.format(os.getpid(),
+                                                     uuid.uuid4().hex))
+        file_descriptor = os.open(temporary_file_path,
+                                  os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+        try:
+            with os.fdopen(file_descriptor, 'wb') as midi_file:
+                midi_file.write(midi_bytes)
+            with _output_file_index_lock:
+                # Resume from the last index used by this process, or by the
+                # earlier processes, instead of checking every existing output
+                output_file_index = _next_output_file_index.get(
+                    output_file_path)
+                if output_file_index is None:
+                    output_file_index = _read_next_output_file_index(
+                        output_file_path)
+                link_supported = True
+                while True:
+                    output_file = output_file_path.format(output_file_index)
+                    try:
+                        if link_supported:
+                            os.link(temporary_file_path, output_file)
+                        else:
+                            # Exclusive creation still never overwrites an
+                            # output, but readers can see a partial midi
+                            with open(output_file, 'xb') as midi_file:
+                                midi_file.write(midi_bytes)
+                        break
+                    except FileExistsError:
+                        output_file_index += 1
+                    except OSError as e:
+                        if not (link_supported and
+                                e.errno in _link_not_supported_errnos):
+                            raise
+                        link_supported = False
+                _next_output_file_index[output_file_path] = (
+                    output_file_index + 1)
+                _write_next_output_file_index(output_file_path,
+                                              output_file_index + 1)
+        finally:
+            os.remove(temporary_file_path)
+        return output_file
 
     @staticmethod
-    def get_softmax(input_tensor, temperature):
+    def get_gumbel_noise(shape, random_generators):
         """
-        Gets the softmax of a tensor with temperature
+        Draws standard Gumbel noise
 
         Parameters
         ----------
-        input_tensor : numpy array
-            original tensor (e.g. original predictions)
-        temperature : int
-            softmax temperature
+        shape : tuple
+            (N, number of cells) shape of the noise
+        random_generators : np.random.Generator or list of np.random.Generator
+            a generator shared by all the rows, or one generator per row
 
         Returns
         -------
-        tensor : numpy array
-            softmax of input tensor with temperature
+        2d numpy array
+            Gumbel noise of the given shape
         """
-        tensor = input_tensor / temperature
-        tensor = np.exp(tensor)
-        tensor = tensor / np.sum(tensor)
-        return tensor
+        if isinstance(random_generators, np.random.Generator):
+            return random_generators.gumbel(size=shape)
+        return np.stack([
+            random_generator.gumbel(size=shape[1:])
+            for random_generator in random_generators
+        ])
 
     @staticmethod
-    def get_sampled_index(input_tensor):
+    def get_sampled_indices(logits, temperatures, random_generators,
+                            num_notes=1):
         """
-        Gets a randomly chosen index from the input tensor
+        Samples notes from the softmax of logits / temperature of every row
+        without computing the softmax. With the Gumbel-max trick the largest
+        logit / temperature + Gumbel noise is a sample of the softmax, and the
+        num_notes largest are num_notes draws without replacement.
+        Masked notes must have a logit of -inf.
 
         Parameters
         ----------
-        input_tensor : numpy array
-            original tensor
+        logits : 2d numpy array
+            one row of model outputs per sample
+        temperatures : 1d numpy array
+            softmax temperature of every row
+        random_generators : np.random.Generator or list of np.random.Generator
+            a generator shared by all the rows, or one generator per row
+        num_notes : int
+            number of distinct notes to sample per row
+
         Returns
         -------
-        tensor : numpy array
-            softmax of input tensor with temperature
+        2d numpy array
+            (N, num_notes) sampled indices of every row, in the order they were drawn
         """
-
-        sampled_index = np.random.choice(range(input_tensor.size),
-                                         1,
-                                         p=input_tensor.ravel())
-        sampled_index = np.unravel_index(sampled_index, input_tensor.shape)
-        return sampled_index
+        scores = logits / temperatures[:, np.newaxis]
+        scores += Inference.get_gumbel_noise(scores.shape, random_generators)
+        if num_notes == 1:
+            return np.argmax(scores, axis=1)[:, np.newaxis]
+        num_notes = min(num_notes, scores.shape[1])
+        top_indices = np.argpartition(-scores, num_notes - 1,
+                                      axis=1)[:, :num_notes]
+        order = np.argsort(-np.take_along_axis(scores, top_indices, axis=1),
+                           axis=1)
+        return np.take_along_axis(top_indices, order, axis=1)
 
     def generate_composition(self, input_midi_path, inference_params):
         """
@@ -170,25 +451,163 @@ class Inference:
             logger.error("Unable to generate composition.")
             raise
 
-    def convert_midi_to_tensor(self, input_midi_path):
+    def generate_composition_bytes(self, input_midi, inference_params,
+                                   seed=None):
         """
-        Converts a midi to pianoroll tensor
+        Generates a new composition based on an old midi without touching the filesystem
+
+        Parameters
+        ----------
+        input_midi : string, bytes or file-like object
+            input midi path, or its contents
+        inference_params : json
+            JSON with inference parameters
+        seed : int, optional
+            random seed of the composition, the output is cached in self.cache if given
+
+        Returns
+        -------
+        bytes
+            contents of the generated midi file
+        """
+        try:
+            output_cache_key = None
+            if self.cache is not None and seed is not None:
+                input_midi = self.read_midi_bytes(input_midi)
+                output_cache_key = self.get_output_cache_key(
+                    input_midi, inference_params, seed, 'composition_bytes')
+                output_midi_bytes = self.cache.get('output', output_cache_key)
+                if output_midi_bytes is not None:
+                    return output_midi_bytes
+            input_tensor = self.convert_midi_to_tensor(input_midi)
+            output_tensor = self.sample_multiple_batch(
+                input_tensor, inference_params['temperature'],
+                inference_params['maxPercentageOfInitialNotesRemoved'],
+                inference_params['maxNotesAdded'],
+                inference_params['samplingIterations'],
+                None if seed is None else [seed],
+                inference_params.get('notesPerIteration', 1))[0]
+            output_midi_bytes = self.convert_tensor_to_midi_bytes(
+                output_tensor, Constants.tempo)
+            if output_cache_key is not None:
+                self.cache.put('output', output_cache_key, output_midi_bytes)
+            return output_midi_bytes
+        except Exception:
+            logger.error("Unable to generate composition.")
+            raise
+
+    def generate_compositions(self,
+                              input_midi_paths,
+                              inference_params,
+                              temperatures=None,
+                              seeds=None,
+                              callback=None):
+        """
+        Generates new compositions for a batch of midis, running every
+        sampling iteration as a single batched forward pass
+
+        Parameters
+        ----------
+        input_midi_paths : list of str
+            input midi paths, the same path can be repeated for variations
+        inference_params : json
+            JSON with inference parameters
+        temperatures : list of float, optional
+            temperature of every composition, defaults to inference_params['temperature']
+        seeds : list of int, optional
+            random seed of every composition
+        callback : callable, optional
+            called after every sampling iteration with a dict of metrics
+
+        Returns
+        -------
+        3d numpy array
+            output tensors (i.e. new compositions)
+        """
+        try:
+            input_tensor = np.concatenate([
+                self.convert_midi_to_tensor(input_midi_path)
+                for input_midi_path in input_midi_paths
+            ])
+            if temperatures is None:
+                temperatures = inference_params['temperature']
+            output_tensors = self.sample_multiple_batch(
+                input_tensor, temperatures,
+                inference_params['maxPercentageOfInitialNotesRemoved'],
+                inference_params['maxNotesAdded'],
+                inference_params['samplingIterations'], seeds,
+                inference_params.get('notesPerIteration', 1), callback)
+            for output_tensor in output_tensors:
+                self.convert_tensor_to_midi(output_tensor, Constants.tempo,
+                                            Constants.output_file_path)
+            return output_tensors
+        except Exception:
+            logger.error("Unable to generate compositions.")
+            raise
+
+    def generate_variations(self,
+                            input_midi_path,
+                            inference_params,
+                            number_of_variations,
+                            temperatures=None,
+                            seeds=None):
+        """
+        Generates independent variations of one midi in a single batch
+
+        Parameters
+        ----------
+        input_midi_path : str
+            input midi path
+        inference_params : json
+            JSON with inference parameters
+        number_of_variations : int
+            number of compositions to generate
+        temperatures : list of float, optional
+            temperature of every variation, defaults to inference_params['temperature']
+        seeds : list of int, optional
+            random seed of every variation
+
+        Returns
+        -------
+        3d numpy array
+            output tensors (i.e. new compositions)
+        """
+        return self.generate_compositions(
+            [input_midi_path] * number_of_variations, inference_params,
+            temperatures, seeds)
+
+    def convert_midi_to_pianoroll(self, input_midi):
+        """
+        Converts a midi of any length to a pianoroll
 
         Parameters
         ----------
-        input_midi_path : string
-            Full file path to the input midi
+        input_midi : string, bytes or file-like object
+            Full file path to the input midi, or its contents
 
         Returns
         -------
         2d numpy array
-            2d tensor that is a pianoroll
+            (timesteps, pitches) pianoroll cropped to the pitch window of the
+            model, padded to a multiple of 8 bars, read-only when it comes
+            from self.cache
         """
 
+        if self.cache is not None:
+            input_midi = self.read_midi_bytes(input_midi)
+            cache_key = self.cache.get_key(
+                input_midi, str(Constants.beat_resolution),
+                str(self.number_of_timesteps), str(Constants.lowest_pitch),
+                str(Constants.number_of_pitches))
+            pianoroll = self.cache.get('input', cache_key)
+            if pianoroll is not None:
+                return pianoroll
+        if isinstance(input_midi, (bytes, bytearray)):
+            input_midi = io.BytesIO(input_midi)
         multi_track = pypianoroll.Multitrack(
             beat_resolution=Constants.beat_resolution)
         try:
-            multi_track.parse_midi(input_midi_path,
+            multi_track.parse_midi(input_midi,
                                    algorithm='custom',
                                    first_beat_time=0)
         except Exception as e:
@@ -200,9 +619,40 @@ class Inference:
         multi_track.pad_to_multiple(self.number_of_timesteps)
         multi_track.binarize()
         pianoroll = multi_track.tracks[0].pianoroll
+        highest_pitch = Constants.lowest_pitch + Constants.number_of_pitches
+        if (pianoroll[:, :Constants.lowest_pitch].any()
+                or pianoroll[:, highest_pitch:].any()):
+            logger.warning(
+                "Input MIDI file has notes outside of the pitches {} to {} of "
+                "the model, they are ignored.".format(Constants.lowest_pitch,
+                                                      highest_pitch - 1))
+        pianoroll = np.ascontiguousarray(
+            crop_pitches(pianoroll, Constants.lowest_pitch,
+                         Constants.number_of_pitches))
+        if self.cache is not None:
+            self.cache.put('input', cache_key, pianoroll)
+        return pianoroll
+
+    def convert_midi_to_tensor(self, input_midi):
+        """
+        Converts a midi to pianoroll tensor
+
+        Parameters
+        ----------
+        input_midi : string, bytes or file-like object
+            Full file path to the input midi, or its contents
+
+        Returns
+        -------
+        2d numpy array
+            2d tensor that is a pianoroll
+        """
+
+        pianoroll = self.convert_midi_to_pianoroll(input_midi)
 
         if pianoroll.shape[0] > self.number_of_timesteps:
-            logger.error("Input MIDI file is longer than 8 bars.")
+            logger.error("Input MIDI file is longer than 8 bars, use "
+                         "generate_long_composition to keep all of it.")
 
         # truncate
         tensor = pianoroll[0:self.number_of_timesteps, ]
@@ -211,26 +661,297 @@ class Inference:
 
         return tensor
 
-    def mask_not_allowed_notes(self, current_input_indices, output_tensor):
+    def get_window_starts(self, pianoroll_length, overlap_timesteps):
+        """
+        Places overlapping model windows over a pianoroll of any length
+
+        Parameters
+        ----------
+        pianoroll_length : int
+            number of timesteps of the pianoroll, at least one window
+        overlap_timesteps : int
+            number of timesteps shared by consecutive windows
+
+        Returns
+        -------
+        1d numpy array
+            first timestep of every window, the last window ends with the pianoroll
+        """
+
+        if not 0 <= overlap_timesteps < self.number_of_timesteps:
+            raise ValueError(
+                "Window overlap must be between 0 and {} timesteps.".format(
+                    self.number_of_timesteps - 1))
+        if pianoroll_length < self.number_of_timesteps:
+            raise ValueError(
+                "The pianoroll has {} timesteps, at least one window of {} "
+                "timesteps is needed.".format(pianoroll_length,
+                                              self.number_of_timesteps))
+        last_start = pianoroll_length - self.number_of_timesteps
+        starts = np.arange(0, last_start + 1,
+                           self.number_of_timesteps - overlap_timesteps)
+        if starts[-1] != last_start:
+            starts = np.append(starts, last_start)
+        return starts
+
+    def get_window_boundaries(self, window_starts):
+        """
+        Splits every overlap between consecutive windows at its middle, so
+        that every timestep belongs to exactly one window
+
+        Parameters
+        ----------
+        window_starts : 1d numpy array
+            first timestep of every window, see get_window_starts
+
+        Returns
+        -------
+        2d numpy array
+            (windows, 2) first and last + 1 timestep owned by every window
+        """
+
+        window_ends = window_starts + self.number_of_timesteps
+        boundaries = np.empty((len(window_starts), 2), dtype=np.int64)
+        boundaries[0, 0] = 0
+        boundaries[1:, 0] = (window_starts[1:] + window_ends[:-1]) // 2
+        boundaries[:-1, 1] = boundaries[1:, 0]
+        boundaries[-1, 1] = window_ends[-1]
+        return boundaries
+
+    @staticmethod
+    def split_note_budget(budget, weights):
+        """
+        Splits a note budget into integer budgets proportional to weights with
+        the largest remainder method, so that they add up to the budget exactly.
+        Ties go to the first weights.
+
+        Parameters
+        ----------
+        budget : int
+            number of notes to split
+        weights : 1d numpy array
+            non negative weight of every part, split evenly if they are all 0
+
+        Returns
+        -------
+        1d numpy array
+            budget of every part
+        """
+
+        weights = np.asarray(weights, dtype=np.float64)
+        if not weights.any():
+            weights = np.ones_like(weights)
+        quotas = budget * weights / weights.sum()
+        budgets = np.floor(quotas).astype(np.int64)
+        remainder = int(budget - budgets.sum())
+        largest_remainders = np.argsort(budgets - quotas, kind='stable')
+        budgets[largest_remainders[:remainder]] += 1
+        return budgets
+
+    def sample_long_input(self,
+                          pianoroll,
+                          temperature,
+                          max_removal_percentage,
+                          max_notes_to_add,
+                          number_of_iterations,
+                          overlap_timesteps=None,
+                          note_budget='global',
+                          seed=None,
+                          num_notes=1,
+                          callback=None):
+        """
+        Samples a pianoroll of any length as one batch of overlapping windows.
+        Every window only edits the timesteps it owns, see get_window_boundaries,
+        and sees the rest of the window as context, so stitching the owned
+        timesteps back together is deterministic and loses no sampled note.
+
+        Parameters
+        ----------
+        pianoroll : 2d numpy array
+            (timesteps, pitches) original pianoroll, at least one window long
+        temperature : float
+            temperature to apply before softmax during inference
+        max_removal_percentage : float
+            maximum percentage of notes that can be removed from the original input
+        max_notes_to_add : int
+            maximum number of notes that can be added to the original input
+        number_of_iterations : int
+            number of iterations to sample from the model predictions
+        overlap_timesteps : int, optional
+            number of timesteps shared by consecutive windows, defaults to the
+            overlap of the training samples
+        note_budget : str
+            'global' to apply the note budgets to the whole pianoroll, split between
+            the windows in proportion to the original notes and timesteps they own,
+            or 'window' to apply them to the timesteps owned by every window
+        seed : int, optional
+            random seed of the composition, unseeded if not given
+        num_notes : int or callable
+            number of notes to sample per forward pass, see sample_multiple_batch
+        callback : callable, optional
+            called after every iteration with a dict of metrics, see SamplingMetricsRecorder
+
+        Returns
+        -------
+        2d numpy array
+            output pianoroll (i.e. new composition) of the same shape as pianoroll
+        """
+
+        if overlap_timesteps is None:
+            overlap_timesteps = self.number_of_timesteps - (
+                Constants.beat_resolution * Constants.beats_per_bar *
+                Constants.bars_shifted_per_sample)
+        pianoroll = np.asarray(pianoroll, dtype=np.bool_)
+        window_starts = self.get_window_starts(len(pianoroll),
+                                               overlap_timesteps)
+        boundaries = self.get_window_boundaries(window_starts)
+        number_of_windows = len(window_starts)
+
+        window_timesteps = (window_starts[:, np.newaxis] +
+                            np.arange(self.number_of_timesteps))
+        input_tensor = pianoroll[window_timesteps][..., np.newaxis]
+        editable_notes = np.zeros(
+            (number_of_windows, self.number_of_timesteps,
+             Constants.number_of_pitches),
+            dtype=np.bool_)
+        for window, (start, end) in enumerate(boundaries):
+            editable_notes[window, start - window_starts[window]:end -
+                           window_starts[window]] = True
+
+        if note_budget == 'global':
+            owned_notes = np.count_nonzero(
+                input_tensor[..., 0] & editable_notes, axis=(1, 2))
+            max_notes_to_remove = self.split_note_budget(
+                int(max_removal_percentage * owned_notes.sum() / 100),
+                owned_notes)
+            # The sampler lets a sample add one note more than its budget,
+            # which would add up to one extra note per window, so the shares
+            # are lowered by one to keep the whole pianoroll within budget
+            max_notes_to_add = self.split_note_budget(
+                max_notes_to_add, boundaries[:, 1] - boundaries[:, 0]) - 1
+        elif note_budget == 'window':
+            max_notes_to_remove = None
+        else:
+            raise ValueError(
+                "Unknown note budget {}, expected 'global' or 'window'.".
+                format(note_budget))
+
+        output_tensors = self.sample_multiple_batch(
+            input_tensor,
+            temperature,
+            max_removal_percentage,
+            max_notes_to_add,
+            number_of_iterations,
+            None if seed is None else [[seed, window]
+                                       for window in range(number_of_windows)],
+            num_notes,
+            callback,
+            editable_notes=editable_notes,
+            max_notes_to_remove=max_notes_to_remove)
+
+        output_pianoroll = np.empty_like(pianoroll)
+        for window, (start, end) in enumerate(boundaries):
+            output_pianoroll[start:end] = output_tensors[
+                window, start - window_starts[window]:end -
+                window_starts[window]]
+        return output_pianoroll
+
+    def generate_long_composition(self, input_midi, inference_params,
+                                  seed=None):
+        """
+        Generates a new composition based on an old midi of any length,
+        sampling all its overlapping 8 bar windows as one batch
+
+        Parameters
+        ----------
+        input_midi : string, bytes or file-like object
+            input midi path, or its contents
+        inference_params : json
+            JSON with inference parameters, 'windowOverlapBars' and 'noteBudget'
+            optionally set the overlap_timesteps and note_budget of sample_long_input
+        seed : int, optional
+            random seed of the composition, the output is cached in self.cache if given
+
+        Returns
+        -------
+        2d numpy array
+            output pianoroll (i.e. new composition), read-only when it comes
+            from self.cache
+        """
+        try:
+            output_cache_key = None
+            if self.cache is not None and seed is not None:
+                input_midi = self.read_midi_bytes(input_midi)
+                output_cache_key = self.get_output_cache_key(
+                    input_midi, inference_params, seed, 'long_composition')
+                output_pianoroll = self.cache.get('output', output_cache_key)
+                if output_pianoroll is not None:
+                    self.convert_tensor_to_midi(output_pianoroll,
+                                                Constants.tempo,
+                                                Constants.output_file_path)
+                    return output_pianoroll
+            pianoroll = self.convert_midi_to_pianoroll(input_midi)
+            overlap_bars = inference_params.get(
+                'windowOverlapBars',
+                Constants.bars - Constants.bars_shifted_per_sample)
+            output_pianoroll = self.sample_long_input(
+                pianoroll, inference_params['temperature'],
+                inference_params['maxPercentageOfInitialNotesRemoved'],
+                inference_params['maxNotesAdded'],
+                inference_params['samplingIterations'],
+                overlap_bars * Constants.beat_resolution *
+                Constants.beats_per_bar,
+                inference_params.get('noteBudget', 'global'), seed,
+                inference_params.get('notesPerIteration', 1))
+            if output_cache_key is not None:
+                self.cache.put('output', output_cache_key, output_pianoroll)
+            self.convert_tensor_to_midi(output_pianoroll, Constants.tempo,
+                                        Constants.output_file_path)
+            return output_pianoroll
+        except Exception:
+            logger.error("Unable to generate composition.")
+            raise
+
+    @staticmethod
+    def linear_num_notes_schedule(max_num_notes):
+        """
+        Schedule for sample_multiple_batch that samples many notes per forward
+        pass in the first iterations and a single note in the last ones
+
+        Parameters
+        ----------
+        max_num_notes : int
+            number of notes sampled in the first iteration
+
+        Returns
+        -------
+        callable
+            number of notes to sample for (iteration, number_of_iterations),
+            decreasing linearly from max_num_notes to 1
+        """
+        def schedule(iteration, number_of_iterations):
+            remaining = 1 - iteration / max(number_of_iterations - 1, 1)
+            return 1 + int(round((max_num_notes - 1) * remaining))
+
+        return schedule
+
+    def mask_not_allowed_notes(self, not_allowed_notes, output_tensor):
         """
         Masks notes in output tensor that cannot be added or removed
 
         Parameters
         ----------
-        current_input_indices : 2d numpy array
-          indices to be masked based on the current input that was fed to model
+        not_allowed_notes : 2d boolean numpy array
+          mask of the notes that cannot be added or removed, one row per sample
         output_tensor : 2d numpy array
-          consists of probabilities that are predicted by the model
+          consists of logits that are predicted by the model, one row per sample
 
         Returns
         -------
-        2d numpy array - output tensor with not allowed notes masked
+        2d numpy array - output tensor with the logits of not allowed notes set to -inf
         """
 
-        if len(current_input_indices) != 0:
-            output_tensor[tuple(np.asarray(list(current_input_indices)).T)] = 0
-            if np.count_nonzero(output_tensor) != 0:
-                output_tensor = output_tensor / np.sum(output_tensor)
+        np.putmask(output_tensor, not_allowed_notes, -np.inf)
         return output_tensor
 
     def sample_multiple(self, input_tensor, temperature,
@@ -259,113 +980,353 @@ class Inference:
             output tensor (i.e. new composition)
         """
 
-        max_original_notes_to_remove = int(
-            max_removal_percentage * np.count_nonzero(input_tensor) / 100)
-        notes_removed_count = 0
-        notes_added_count = 0
+        return self.sample_multiple_batch(input_tensor, temperature,
+                                          max_removal_percentage,
+                                          max_notes_to_add,
+                                          number_of_iterations)[0]
+
+    def sample_multiple_batch(self,
+                              input_tensor,
+                              temperatures,
+                              max_removal_percentage,
+                              max_notes_to_add,
+                              number_of_iterations,
+                              seeds=None,
+                              num_notes=1,
+                              callback=None,
+                              editable_notes=None,
+                              max_notes_to_remove=None):
+        """
+        Samples multiple times from a batch of tensors with one forward pass per iteration.
+        Masking, note budgets and sampling are applied to every sample independently.
+        Sampling stops early once every sample has used up both its note budgets,
+        or has no note left that it can edit.
 
-        original_input_one_indices = self.get_indices(input_tensor, 1)
-        original_input_zero_indices = self.get_indices(input_tensor, 0)
+        Parameters
+        ----------
+        input_tensor : 4d numpy array
+            original tensors (i.e. user input melodies) of shape (N, timesteps, pitches, 1)
+        temperatures : float or list of float
+            temperature to apply before softmax during inference, per sample
+        max_removal_percentage : float
+            maximum percentage of notes that can be removed from each original input
+        max_notes_to_add : int or list of int
+            maximum number of notes that can be added to each original input
+        number_of_iterations : int
+            number of iterations to sample from the model predictions
+        seeds : list of int, optional
+            random seed of every sample, unseeded if not given
+        num_notes : int or callable
+            number of notes to sample per forward pass, or a schedule called with
+            (iteration, number_of_iterations) that returns it, see linear_num_notes_schedule
+        callback : callable, optional
+            called after every iteration with a dict of metrics, see SamplingMetricsRecorder
+        editable_notes : 3d boolean numpy array, optional
+            (N, timesteps, pitches) mask of the notes that can be added or removed,
+            the other notes are left as they are. Every note is editable if not given
+        max_notes_to_remove : list of int, optional
+            maximum number of original notes that can be removed from each input,
+            overrides max_removal_percentage
+
+        Returns
+        -------
+        3d numpy array
+            output tensors (i.e. new compositions) of shape (N, timesteps, pitches)
+        """
+
+        input_tensor = input_tensor.astype(np.bool_)
+        batch_size = len(input_tensor)
+        # Flat (N, timesteps * pitches) views of the sampler state
+        current_input = input_tensor.reshape(batch_size, -1)
+        original_input = current_input.copy()
+        current_removed = np.zeros_like(original_input)
+        current_added = np.zeros_like(original_input)
+        not_allowed_notes = np.zeros_like(original_input)
+        if editable_notes is not None:
+            fixed_notes = ~np.asarray(editable_notes, dtype=np.bool_).reshape(
+                batch_size, -1)
+        else:
+            fixed_notes = None
 
-        current_input_one_indices = copy.deepcopy(original_input_one_indices)
-        current_input_zero_indices = copy.deepcopy(original_input_zero_indices)
+        if max_notes_to_remove is not None:
+            max_original_notes_to_remove = np.broadcast_to(
+                np.asarray(max_notes_to_remove, dtype=np.int64),
+                (batch_size, ))
+        else:
+            # Only the original notes that can be edited count towards the budget
+            removable_notes = original_input if fixed_notes is None else (
+                original_input & ~fixed_notes)
+            max_original_notes_to_remove = (
+                max_removal_percentage *
+                np.count_nonzero(removable_notes, axis=1) / 100).astype(
+                    np.int64)
+        max_notes_to_add = np.broadcast_to(
+            np.asarray(max_notes_to_add, dtype=np.int64), (batch_size, ))
+        notes_removed_count = np.zeros(batch_size, dtype=np.int64)
+        notes_added_count = np.zeros(batch_size, dtype=np.int64)
+        temperatures = np.broadcast_to(
+            np.asarray(temperatures, dtype=np.float64), (batch_size, ))
+        random_generators = np.random.default_rng() if seeds is None else [
+            np.random.default_rng(seed) for seed in seeds
+        ]
 
-        for _ in range(number_of_iterations):
-            input_tensor, notes_removed_count, notes_added_count = self.sample_notes_from_model(
-                input_tensor, max_original_notes_to_remove, max_notes_to_add,
-                temperature, notes_removed_count, notes_added_count,
-                original_input_one_indices, original_input_zero_indices,
-                current_input_zero_indices, current_input_one_indices)
+        timings = {} if callback is not None else None
+        for iteration in range(number_of_iterations):
+            if callback is not None:
+                previous_removed_count = notes_removed_count.copy()
+                previous_added_count = notes_added_count.copy()
+            moves_possible = self.sample_notes_from_model(
+                input_tensor,
+                max_original_notes_to_remove,
+                max_notes_to_add,
+                temperatures,
+                notes_removed_count,
+                notes_added_count,
+                original_input,
+                current_removed,
+                current_added,
+                not_allowed_notes,
+                random_generators,
+                num_notes=num_notes(iteration, number_of_iterations)
+                if callable(num_notes) else num_notes,
+                timings=timings,
+                fixed_notes=fixed_notes)
+            if not moves_possible:
+                # Every sample has used up its note budgets or has nothing
+                # left to edit, further iterations would only undo edits
+                logger.info(
+                    "Stopped sampling after {} of {} iterations, the note "
+                    "budgets are used up.".format(iteration,
+                                                  number_of_iterations))
+                break
+            if callback is not None:
+                callback({
+                    'iteration': iteration,
+                    'forward_pass_seconds': timings['forward_pass_seconds'],
+                    'sampling_seconds': timings['sampling_seconds'],
+                    'notes_removed':
+                    notes_removed_count - previous_removed_count,
+                    'notes_added':
+                    notes_added_count - previous_added_count,
+                    'remaining_notes_to_remove':
+                    max_original_notes_to_remove - notes_removed_count,
+                    'remaining_notes_to_add':
+                    max_notes_to_add - notes_added_count
+                })
 
-        return input_tensor.reshape(self.number_of_timesteps,
+        return input_tensor.reshape(batch_size, self.number_of_timesteps,
                                     Constants.number_of_pitches)
 
     def sample_notes_from_model(self,
                                 input_tensor,
                                 max_original_notes_to_remove,
                                 max_notes_to_add,
-                                temperature,
+                                temperatures,
                                 notes_removed_count,
                                 notes_added_count,
-                                original_input_one_indices,
-                                original_input_zero_indices,
-                                current_input_zero_indices,
-                                current_input_one_indices,
-                                num_notes=1):
+                                original_input,
+                                current_removed,
+                                current_added,
+                                not_allowed_notes,
+                                random_generators,
+                                num_notes=1,
+                                timings=None,
+                                fixed_notes=None):
         """
-        Generates a sample from the tensor and return a new tensor
-        Modifies current_input_zero_indices, current_input_one_indices, and input_tensor
+        Samples a note for every tensor of the batch from one forward pass of the model
+        Modifies input_tensor, the note counts and all the masks in place
 
         Parameters
         ----------
-        input_tensor : 2d numpy array
-            input tensor to feed into the model
-        max_original_notes_to_remove : int
-            maximum number of notes to remove from the original input
-        max_notes_to_add : int
-            maximum number of notes that can be added to the original input
-        temperature : float
-            temperature to apply before softmax during inference
-        notes_removed_count : int
-            number of original notes that have been removed from input
-        notes_added_count : int
-            number of new notes that have been added to the input
-        original_input_one_indices : set of tuples
-            indices which have value 1 in original input
-        original_input_zero_indices : set of tuples
-            indices which have value 0 in original input
-        current_input_zero_indices : set of tuples
-            indices which have value 0 and were not part of the original input
-        current_input_one_indices : set of tuples
-            indices which have value 1 and were part of the original input
+        input_tensor : 4d boolean numpy array
+            input tensors to feed into the model, of shape (N, timesteps, pitches, 1)
+        max_original_notes_to_remove : 1d numpy array
+            maximum number of notes to remove from each original input
+        max_notes_to_add : 1d numpy array
+            maximum number of notes that can be added to each original input
+        temperatures : 1d numpy array
+            temperature to apply before softmax during inference, per sample
+        notes_removed_count : 1d numpy array
+            number of original notes that have been removed from each input
+        notes_added_count : 1d numpy array
+            number of new notes that have been added to each input
+        original_input : 2d boolean numpy array
+            mask of the notes of the original inputs, one flattened row per sample
+        current_removed : 2d boolean numpy array
+            mask of the notes of the original inputs that are currently removed
+        current_added : 2d boolean numpy array
+            mask of the notes not in the original inputs that are currently added
+        not_allowed_notes : 2d boolean numpy array
+            preallocated scratch mask of the notes that cannot be sampled
+        random_generators : np.random.Generator or list of np.random.Generator
+            a generator shared by all the samples, or one generator per sample
+        num_notes : int
+            number of distinct notes to sample per sample from the forward pass
+        timings : dict, optional
+            filled with the forward_pass_seconds and sampling_seconds of the iteration
+        fixed_notes : 2d boolean numpy array, optional
+            mask of the notes that can never be sampled, one flattened row per sample
 
         Returns
         -------
-        input_tensor : 2d numpy array
-            output after samping from the model prediction
-        notes_removed_count : int
-            updated number of original notes removed
-        notes_added_count : int
-            updated number of new notes added
-        """
-
-        output_tensor = self.model.predict([input_tensor])
-
-        # Apply temperature and softmax
-        output_tensor = self.get_softmax(output_tensor, temperature)
-
-        if notes_removed_count >= max_original_notes_to_remove:
-            # Mask all pixels that both have a note and were once part of the original input
-            output_tensor = self.mask_not_allowed_notes(current_input_one_indices, output_tensor)
-
-        if notes_added_count > max_notes_to_add:
-            # Mask all pixels that both do not have a note and were not once part of the original input
-            output_tensor = self.mask_not_allowed_notes(current_input_zero_indices, output_tensor)
-
-        if np.count_nonzero(output_tensor) == 0:
-            return input_tensor, notes_removed_count, notes_added_count
-
-        sampled_index = self.get_sampled_index(output_tensor)
-        sampled_index_transpose = tuple(np.array(sampled_index).T[0])
-
-        if input_tensor[sampled_index]:
-            # Check if the note being removed is from the original input
-            if notes_removed_count < max_original_notes_to_remove and (
-                sampled_index_transpose in original_input_one_indices):
-                notes_removed_count += 1
-                current_input_one_indices.remove(sampled_index_transpose)
-            elif tuple(sampled_index_transpose) not in original_input_one_indices:
-                notes_added_count -= 1
-                current_input_zero_indices.add(sampled_index_transpose)
-            input_tensor[sampled_index] = 0
+        bool
+            False if no sample can change anymore, or every sample has used up
+            both its note budgets, in which case the model is not run
+        """
+
+        batch_size = len(input_tensor)
+        # Mask all pixels that both have a note and were once part of the original input
+        removal_blocked = notes_removed_count >= max_original_notes_to_remove
+        # Mask all pixels that both do not have a note and were not once part of the original input
+        addition_blocked = notes_added_count > max_notes_to_add
+        masked = (removal_blocked.any() or addition_blocked.any()
+                  or fixed_notes is not None)
+        if masked:
+            np.logical_and(original_input, ~current_removed,
+                           out=not_allowed_notes)
+            not_allowed_notes &= removal_blocked[:, np.newaxis]
+            not_allowed_notes |= (addition_blocked[:, np.newaxis] &
+                                  ~original_input & ~current_added)
+            if fixed_notes is not None:
+                not_allowed_notes |= fixed_notes
+            allowed_notes_count = original_input.shape[1] - np.count_nonzero(
+                not_allowed_notes, axis=1)
         else:
-            # Check if the note being added is not in original input
-            if sampled_index_transpose not in original_input_one_indices:
-                notes_added_count += 1
-                current_input_zero_indices.remove(sampled_index_transpose)
-            else:
-                notes_removed_count -= 1
-                current_input_one_indices.add(sampled_index_transpose)
-            input_tensor[sampled_index] = 1
-        input_tensor = input_tensor.astype(np.bool_)
-        return input_tensor, notes_removed_count, notes_added_count
+            allowed_notes_count = np.full(batch_size, original_input.shape[1])
+
+        # Samples with every note masked cannot change anymore,
+        # since the masks only change when a note is sampled.
+        # Samples that used up both budgets are done as well: they could only
+        # undo their own edits, which reopens a budget that the next
+        # iterations spend again, e.g. adding and removing the same note
+        budgets_used_up = removal_blocked & addition_blocked
+        samples = np.flatnonzero((allowed_notes_count > 0) & ~budgets_used_up)
+        if len(samples) == 0:
+            return False
+        if len(samples) < batch_size:
+            model_input = input_tensor[samples]
+            if not isinstance(random_generators, np.random.Generator):
+                random_generators = [
+                    random_generators[sample] for sample in samples
+                ]
+        else:
+            model_input = input_tensor
+
+        start_time = time.perf_counter()
+        output_tensor = self.model.predict(model_input)
+        forward_pass_time = time.perf_counter() - start_time
+        output_tensor = output_tensor.reshape(len(samples),
+                                              -1).astype(np.float64)
+        if masked:
+            output_tensor = self.mask_not_allowed_notes(
+                not_allowed_notes[samples], output_tensor)
+
+        sampled_indices = self.get_sampled_indices(output_tensor,
+                                                   temperatures[samples],
+                                                   random_generators,
+                                                   num_notes)
+        # Apply the notes in the order they were drawn
+        for note in range(sampled_indices.shape[1]):
+            drawn = allowed_notes_count[samples] > note
+            if not drawn.any():
+                break
+            self.update_sampled_notes(samples[drawn],
+                                      sampled_indices[drawn, note],
+                                      input_tensor,
+                                      max_original_notes_to_remove,
+                                      max_notes_to_add, notes_removed_count,
+                                      notes_added_count, original_input,
+                                      current_removed, current_added)
+        if timings is not None:
+            timings['forward_pass_seconds'] = forward_pass_time
+            timings['sampling_seconds'] = (time.perf_counter() - start_time -
+                                           forward_pass_time)
+        return True
+
+    @staticmethod
+    def update_sampled_notes(samples, sampled_indices, input_tensor,
+                             max_original_notes_to_remove, max_notes_to_add,
+                             notes_removed_count, notes_added_count,
+                             original_input, current_removed, current_added):
+        """
+        Flips the sampled note of every sample that is still within its note budgets
+        Modifies input_tensor, the note counts and all the masks in place
+
+        Parameters
+        ----------
+        samples : 1d numpy array
+            samples of the batch a note was sampled for
+        sampled_indices : 1d numpy array
+            flat index of the note sampled for each of the samples
+        Other parameters are the same as sample_notes_from_model
+
+        Returns
+        -------
+        None
+        """
+        current_input = input_tensor.reshape(len(input_tensor), -1)
+        has_note = current_input[samples, sampled_indices]
+        is_original = original_input[samples, sampled_indices]
+        # Notes that are masked once a budget is used up, checked again here
+        # because several notes can be applied from one forward pass
+        allowed = ~(has_note & is_original &
+                    (notes_removed_count[samples] >=
+                     max_original_notes_to_remove[samples]))
+        allowed &= ~(~has_note & ~is_original &
+                     (notes_added_count[samples] > max_notes_to_add[samples]))
+        samples = samples[allowed]
+        sampled_indices = sampled_indices[allowed]
+        has_note = has_note[allowed]
+        is_original = is_original[allowed]
+
+        # Removing an original note
+        removed_original = has_note & is_original
+        notes_removed_count[samples[removed_original]] += 1
+        current_removed[samples[removed_original],
+                        sampled_indices[removed_original]] = True
+        # Removing an added note
+        removed_added = has_note & ~is_original
+        notes_added_count[samples[removed_added]] -= 1
+        current_added[samples[removed_added],
+                      sampled_indices[removed_added]] = False
+        # Adding a note that is not in the original input
+        added_new = ~has_note & ~is_original
+        notes_added_count[samples[added_new]] += 1
+        current_added[samples[added_new], sampled_indices[added_new]] = True
+        # Adding back a removed original note
+        added_back = ~has_note & is_original
+        notes_removed_count[samples[added_back]] -= 1
+        current_removed[samples[added_back],
+                        sampled_indices[added_back]] = False
+        current_input[samples, sampled_indices] = ~has_note
+
+
+class SamplingMetricsRecorder:
+    """
+    Callback for Inference.sample_multiple_batch that records the metrics of every iteration
+    """
+    def __init__(self):
+        self.iterations = []
+
+    def __call__(self, metrics):
+        self.iterations.append(metrics)
+
+    def summary(self):
+        """
+        Returns
+        -------
+        dict
+            totals over the recorded iterations
+        """
+        return {
+            'iterations':
+            len(self.iterations),
+            'forward_pass_seconds':
+            sum(metrics['forward_pass_seconds'] for metrics in self.iterations),
+            'sampling_seconds':
+            sum(metrics['sampling_seconds'] for metrics in self.iterations),
+            'iterations_without_changes':
+            sum(1 for metrics in self.iterations
+                if not (np.any(metrics['notes_removed'])
+                        or np.any(metrics['notes_added'])))
+        }
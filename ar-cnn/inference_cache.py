@@ -0,0 +1,287 @@
+# The MIT-Zero License
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict
+import numpy as np
+
+
+class InferenceCache:
+    """
+    Bounded LRU cache of inference values (parsed input pianorolls and
+    outputs of seeded requests), keyed by content hashes.
+    Entries evicted from memory are spilled to cache_dir when it is given
+    and loaded back on their next request. Spill files are bounded by
+    max_spill_bytes as well, the least recently used ones are deleted.
+    Safe to share between threads, files are read and written outside of
+    the lock.
+    """
+    def __init__(self,
+                 max_bytes=64 * 2**20,
+                 cache_dir=None,
+                 max_spill_bytes=1024 * 2**20):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        # Evicted entries being written to their spill file
+        self.spilling = {}
+        # (path, size) of every spill file, least recently used first
+        self.spilled = OrderedDict()
+        self.spilled_nbytes = 0
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._index_spill_files()
+
+    @staticmethod
+    def get_key(*parts):
+        """
+        Hashes the parts of a key
+
+        Parameters
+        ----------
+        parts : bytes or str
+            content of the key, e.g. a midi file and the inference parameters
+
+        Returns
+        -------
+        str
+            hexadecimal sha1 of the parts
+        """
+        key = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            # Length prefix so that different splits of the same bytes differ
+            key.update(len(part).to_bytes(8, 'little'))
+            key.update(part)
+        return key.hexdigest()
+
+    @staticmethod
+    def get_nbytes(value):
+        return value.nbytes if isinstance(value, np.ndarray) else len(value)
+
+    def _get_spill_file_path(self, namespace, key, value_type):
+        extension = '.npy' if value_type is np.ndarray else '.bin'
+        return os.path.join(self.cache_dir,
+                            '{}-{}{}'.format(namespace, key, extension))
+
+    def _index_spill_files(self):
+        # Spill files of earlier runs count towards max_spill_bytes,
+        # oldest first
+        spill_files = []
+        for file_name in os.listdir(self.cache_dir):
+            name, extension = os.path.splitext(file_name)
+            if extension not in ('.npy', '.bin') or '-' not in name:
+                continue
+            namespace, key = name.rsplit('-', 1)
+            file_stat = os.stat(os.path.join(self.cache_dir, file_name))
+            spill_files.append((file_stat.st_mtime, namespace, key,
+                                os.path.join(self.cache_dir, file_name),
+                                file_stat.st_size))
+        for _, namespace, key, spill_file_path, size in sorted(spill_files):
+            self.spilled[namespace, key] = spill_file_path, size
+            self.spilled_nbytes += size
+        self._remove_files(self._evict_spill_files())
+
+    def _evict_spill_files(self):
+        '''Unindexes the least recently used spill files beyond max_spill_bytes
+        :return: paths of the files to remove'''
+        evicted_file_paths = []
+        while self.spilled_nbytes > self.max_spill_bytes and self.spilled:
+            _, (spill_file_path, size) = self.spilled.popitem(last=False)
+            self.spilled_nbytes -= size
+            evicted_file_paths.append(spill_file_path)
+        return evicted_file_paths
+
+    @staticmethod
+    def _remove_files(file_paths):
+        for file_path in file_paths:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    def _spill(self, namespace, key, value):
+        spill_file_path = self._get_spill_file_path(namespace, key,
+                                                    type(value))
+        with self._lock:
+            already_spilled = (namespace, key) in self.spilled
+        if not already_spilled:
+            # Write then rename so that readers never load a partial file
+            file_descriptor, temporary_file_path = tempfile.mkstemp(
+                dir=self.cache_dir)
+            try:
+                with os.fdopen(file_descriptor, 'wb') as spill_file:
+                    if isinstance(value, np.ndarray):
+                        np.save(spill_file, value, allow_pickle=False)
+                    else:
+                        spill_file.write(value)
+                os.replace(temporary_file_path, spill_file_path)
+            except Exception:
+                os.remove(temporary_file_path)
+                with self._lock:
+                    self.spilling.pop((namespace, key), None)
+                raise
+        with self._lock:
+            self.spilling.pop((namespace, key), None)
+            if (namespace, key) not in self.spilled:
+                size = os.path.getsize(spill_file_path)
+                self.spilled[namespace, key] = spill_file_path, size
+                self.spilled_nbytes += size
+            evicted_file_paths = self._evict_spill_files()
+        self._remove_files(evicted_file_paths)
+
+    def _load_spilled(self, spill_file_path):
+        try:
+            if spill_file_path.endswith('.npy'):
+                return np.load(spill_file_path, allow_pickle=False)
+            with open(spill_file_path, 'rb') as spill_file:
+                return spill_file.read()
+        except FileNotFoundError:
+            # Deleted to stay within max_spill_bytes meanwhile
+            return None
+
+    def _insert(self, namespace, key, value):
+        '''Adds a value to the memory cache, the lock must be held
+        :return: (namespace, key, value) of the evicted entries to spill'''
+        self.entries[namespace, key] = value
+        self.nbytes += self.get_nbytes(value)
+        to_spill = []
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            (evicted_namespace,
+             evicted_key), evicted_value = self.entries.popitem(last=False)
+            self.nbytes -= self.get_nbytes(evicted_value)
+            self.counters[evicted_namespace]['evictions'] += 1
+            if self.cache_dir is not None:
+                self.spilling[evicted_namespace, evicted_key] = evicted_value
+                to_spill.append((evicted_namespace, evicted_key, evicted_value))
+        return to_spill
+
+    def _spill_all(self, to_spill):
+        for namespace, key, value in to_spill:
+            self._spill(namespace, key, value)
+
+    def get(self, namespace, key):
+        """
+        Looks up a value and marks it as most recently used
+
+        Parameters
+        ----------
+        namespace : str
+            kind of value, counted separately, e.g. 'input' or 'output'
+        key : str
+            key of the value, see get_key
+
+        Returns
+        -------
+        numpy array, bytes or None
+            read-only cached value, None on a miss
+        """
+        with self._lock:
+            value = self.entries.get((namespace, key))
+            if value is not None:
+                self.entries.move_to_end((namespace, key))
+                self.counters[namespace]['hits'] += 1
+                return value
+            value = self.spilling.get((namespace, key))
+            if value is not None:
+                self.counters[namespace]['hits'] += 1
+                return value
+            spilled = self.spilled.get((namespace, key))
+            if spilled is not None:
+                self.spilled.move_to_end((namespace, key))
+        if spilled is not None:
+            value = self._load_spilled(spilled[0])
+            if value is not None:
+                if isinstance(value, np.ndarray):
+                    value.setflags(write=False)
+                with self._lock:
+                    self.counters[namespace]['spill_hits'] += 1
+                    to_spill = []
+                    if (namespace, key) not in self.entries:
+                        to_spill = self._insert(namespace, key, value)
+                self._spill_all(to_spill)
+                return value
+        with self._lock:
+            self.counters[namespace]['misses'] += 1
+        return None
+
+    def put(self, namespace, key, value):
+        """
+        Caches a value, evicting the least recently used ones beyond max_bytes
+
+        Parameters
+        ----------
+        namespace : str
+            kind of value, see get
+        key : str
+            key of the value, see get_key
+        value : numpy array or bytes
+            value to cache, arrays are copied so the caller's array is left
+            as it is and can still be modified
+
+        Returns
+        -------
+        None
+        """
+        if isinstance(value, np.ndarray):
+            # Cached arrays are shared by every request that hits them
+            value = value.copy()
+            value.setflags(write=False)
+        with self._lock:
+            if (namespace, key) in self.entries:
+                self.entries.move_to_end((namespace, key))
+                return
+            to_spill = self._insert(namespace, key, value)
+        self._spill_all(to_spill)
+
+    def clear(self):
+        """
+        Empties the memory cache, spilled entries are kept
+        """
+        with self._lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict
+            hits, spill_hits, misses and evictions of every namespace, the
+            number of entries and bytes held in memory, and the number of
+            spill files and their bytes
+        """
+        with self._lock:
+            stats = {
+                namespace: dict(counters)
+                for namespace, counters in self.counters.items()
+            }
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.nbytes
+            stats['spilled_entries'] = len(self.spilled)
+            stats['spilled_bytes'] = self.spilled_nbytes
+            return stats
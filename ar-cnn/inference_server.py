@@ -0,0 +1,532 @@
+# The MIT-Zero License
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Long-running local inference server that keeps the model loaded and
+# samples concurrent requests together in shared batched forward passes.
+# Usage:
+#   python inference_server.py --model checkpoints/model.h5 --port 8080
+#   python inference_server.py --model checkpoints/model.h5 --socket /tmp/ar-cnn.sock
+#   python inference_server.py --model serving_model/ --port 8080
+# Requests:
+#   POST /generate?seed=1&params={"temperature":2} with the midi file as body
+#   answers with the generated midi file. Parameters missing from params are
+#   taken from --inference-params.
+#   GET /stats answers with batching and cache statistics as JSON.
+
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+import socketserver
+import numpy as np
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from constants import Constants
+from inference import Inference
+from inference_cache import InferenceCache
+
+logger = logging.getLogger(__name__)
+
+# Seeds of requests, the range of np.random.SeedSequence().entropy
+MAX_SEED = 2**128 - 1
+
+
+class InvalidRequestError(ValueError):
+    """
+    Raised for requests that can never be sampled, answered with 400
+    """
+
+
+# Type and smallest allowed value of the inference parameters
+INFERENCE_PARAMS_TYPES = {
+    'temperature': (float, 0),
+    'maxNotesAdded': (int, 0),
+    'maxPercentageOfInitialNotesRemoved': (float, 0),
+    'samplingIterations': (int, 0),
+    'notesPerIteration': (int, 1),
+}
+
+
+def validate_inference_params(inference_params):
+    """
+    Checks the inference parameters of a request and converts them to the
+    types the sampler expects
+
+    Parameters
+    ----------
+    inference_params : json
+        JSON with inference parameters
+
+    Returns
+    -------
+    dict
+        the inference parameters with int and float values
+
+    Raises
+    ------
+    InvalidRequestError
+        if the parameters are not a JSON object, or a parameter is missing,
+        not a number or out of range
+    """
+    if not isinstance(inference_params, dict):
+        raise InvalidRequestError(
+            "The inference parameters must be a JSON object.")
+    inference_params = dict(inference_params)
+    for name, (value_type, minimum) in INFERENCE_PARAMS_TYPES.items():
+        if name not in inference_params:
+            if name == 'notesPerIteration':
+                continue
+            raise InvalidRequestError(
+                "Missing inference parameter {}.".format(name))
+        value = inference_params[name]
+        try:
+            if isinstance(value, bool):
+                raise TypeError
+            converted = float(value)
+            if value_type is int:
+                if not converted.is_integer():
+                    raise TypeError
+                converted = int(converted)
+        except (TypeError, ValueError, OverflowError):
+            raise InvalidRequestError(
+                "Inference parameter {} must be {}, got {!r}.".format(
+                    name, "an integer" if value_type is int else "a number",
+                    value)) from None
+        if not minimum <= converted < float('inf'):
+            raise InvalidRequestError(
+                "Inference parameter {} must be at least {}, got {!r}.".format(
+                    name, minimum, value))
+        inference_params[name] = converted
+    if inference_params['temperature'] == 0:
+        raise InvalidRequestError(
+            "Inference parameter temperature must be positive.")
+    if inference_params['maxPercentageOfInitialNotesRemoved'] > 100:
+        raise InvalidRequestError(
+            "Inference parameter maxPercentageOfInitialNotesRemoved must be "
+            "at most 100.")
+    return inference_params
+
+
+def validate_seed(seed):
+    """
+    Checks the random seed of a request
+
+    Parameters
+    ----------
+    seed : int, optional
+        random seed of the composition
+
+    Returns
+    -------
+    int
+        the seed, None if not given
+
+    Raises
+    ------
+    InvalidRequestError
+        if the seed is not an integer between 0 and MAX_SEED
+    """
+    if seed is None:
+        return None
+    if (isinstance(seed, bool) or not isinstance(seed, (int, np.integer))
+            or not 0 <= seed <= MAX_SEED):
+        raise InvalidRequestError(
+            "The seed must be an integer between 0 and {}, got {!r}.".format(
+                MAX_SEED, seed))
+    return int(seed)
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent composition requests into batches sampled by one
+    background thread with Inference.sample_multiple_batch, so that every
+    sampling iteration is one forward pass for the whole batch.
+    A batch starts as soon as max_batch_size requests are waiting, or
+    max_wait_seconds after its first request.
+    Requests with different samplingIterations or notesPerIteration are
+    sampled in separate batches, the other parameters can differ per request.
+    """
+    def __init__(self, inference, max_batch_size=16, max_wait_seconds=0.01):
+        self.inference = inference
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.requests = queue.Queue()
+        self.counters = {'requests': 0, 'batches': 0, 'largest_batch': 0}
+        self._counters_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, input_tensor, inference_params, seed=None):
+        """
+        Queues a composition request
+
+        Parameters
+        ----------
+        input_tensor : 4d numpy array
+            (1, timesteps, pitches, 1) input tensor, see Inference.convert_midi_to_tensor
+        inference_params : json
+            JSON with inference parameters
+        seed : int, optional
+            random seed of the composition
+
+        Returns
+        -------
+        Future
+            resolves to the 2d output tensor (i.e. new composition)
+
+        Raises
+        ------
+        InvalidRequestError
+            if the input tensor does not have the shape above, or the
+            inference parameters or the seed are invalid
+        """
+        expected_shape = (1, self.inference.number_of_timesteps,
+                          Constants.number_of_pitches, 1)
+        if np.shape(input_tensor) != expected_shape:
+            raise InvalidRequestError(
+                "The input tensor has shape {}, expected {}.".format(
+                    np.shape(input_tensor), expected_shape))
+        inference_params = validate_inference_params(inference_params)
+        seed = validate_seed(seed)
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        future = Future()
+        self.requests.put((input_tensor, inference_params, seed, future))
+        return future
+
+    def generate_composition_bytes(self, input_midi, inference_params,
+                                   seed=None):
+        """
+        Same as Inference.generate_composition_bytes, sampled in a shared batch
+
+        Parameters
+        ----------
+        input_midi : string, bytes or file-like object
+            input midi path, or its contents
+        inference_params : json
+            JSON with inference parameters
+        seed : int, optional
+            random seed of the composition, the output is cached in the
+            inference cache if given
+
+        Returns
+        -------
+        bytes
+            contents of the generated midi file
+
+        Raises
+        ------
+        InvalidRequestError
+            if the midi file cannot be parsed to a full 8 bar window, or the
+            inference parameters or the seed are invalid, see submit
+        """
+        inference = self.inference
+        inference_params = validate_inference_params(inference_params)
+        seed = validate_seed(seed)
+        output_cache_key = None
+        if inference.cache is not None and seed is not None:
+            input_midi = inference.read_midi_bytes(input_midi)
+            output_cache_key = inference.get_output_cache_key(
+                input_midi, inference_params, seed, 'composition_bytes')
+            output_midi_bytes = inference.cache.get('output', output_cache_key)
+            if output_midi_bytes is not None:
+                return output_midi_bytes
+        # Parsed in the calling thread, the batching thread only samples
+        try:
+            input_tensor = inference.convert_midi_to_tensor(input_midi)
+        except Exception as e:
+            raise InvalidRequestError(
+                "Unable to parse the midi file: {}".format(e)) from e
+        output_tensor = self.submit(input_tensor, inference_params,
+                                    seed).result()
+        output_midi_bytes = inference.convert_tensor_to_midi_bytes(
+            output_tensor, Constants.tempo)
+        if output_cache_key is not None:
+            inference.cache.put('output', output_cache_key, output_midi_bytes)
+        return output_midi_bytes
+
+    def _run(self):
+        closing = False
+        while not closing:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch = [request]
+            deadline = time.monotonic() + self.max_wait_seconds
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        # Nothing may escape this thread, or every later request would hang
+        try:
+            groups = {}
+            for request in batch:
+                inference_params = request[1]
+                groups.setdefault((inference_params['samplingIterations'],
+                                   inference_params.get('notesPerIteration', 1)),
+                                  []).append(request)
+            for (number_of_iterations, num_notes), group in groups.items():
+                self._run_group(group, number_of_iterations, num_notes)
+        except Exception as e:
+            logger.exception("Unable to sample a batch of {} requests.".format(
+                len(batch)))
+            for request in batch:
+                future = request[3]
+                if not future.done():
+                    future.set_exception(e)
+
+    def _run_group(self, group, number_of_iterations, num_notes):
+        input_tensors, group_params, seeds, futures = zip(*group)
+        try:
+            # Budgets are computed per request since their parameters differ
+            max_notes_to_remove = [
+                int(inference_params['maxPercentageOfInitialNotesRemoved'] *
+                    np.count_nonzero(input_tensor) / 100)
+                for input_tensor, inference_params in zip(
+                    input_tensors, group_params)
+            ]
+            output_tensors = self.inference.sample_multiple_batch(
+                np.concatenate(input_tensors), [
+                    inference_params['temperature']
+                    for inference_params in group_params
+                ],
+                0, [
+                    inference_params['maxNotesAdded']
+                    for inference_params in group_params
+                ],
+                number_of_iterations,
+                seeds,
+                num_notes,
+                max_notes_to_remove=max_notes_to_remove)
+        except Exception as e:
+            if len(group) > 1:
+                # Sample the requests one by one so that a bad request only
+                # fails itself
+                logger.warning(
+                    "Unable to sample a batch of {} requests, sampling them "
+                    "separately: {}".format(len(group), e))
+                for request in group:
+                    self._run_group([request], number_of_iterations, num_notes)
+                return
+            logger.exception("Unable to sample a request.")
+            futures[0].set_exception(e)
+            return
+        for future, output_tensor in zip(futures, output_tensors):
+            future.set_result(output_tensor)
+        with self._counters_lock:
+            self.counters['requests'] += len(group)
+            self.counters['batches'] += 1
+            self.counters['largest_batch'] = max(
+                self.counters['largest_batch'], len(group))
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict
+            number of requests and batches sampled, the largest batch and
+            the number of queued requests
+        """
+        with self._counters_lock:
+            stats = dict(self.counters)
+        stats['queued'] = self.requests.qsize()
+        return stats
+
+    def close(self):
+        """
+        Samples the queued requests and stops the batching thread
+        """
+        self.requests.put(None)
+        self._thread.join()
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler of the inference server, see the usage at the top of the file
+    """
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, content):
+        self._send(status, json.dumps(content).encode(), 'application/json')
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/stats':
+            self._send_json(404, {'error': "Unknown path."})
+            return
+        batcher = self.server.batcher
+        stats = {'batching': batcher.stats()}
+        if batcher.inference.cache is not None:
+            stats['cache'] = batcher.inference.cache.stats()
+        self._send_json(200, stats)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/generate':
+            self._send_json(404, {'error': "Unknown path."})
+            return
+        try:
+            query = parse_qs(url.query)
+            inference_params = dict(self.server.inference_params)
+            if 'params' in query:
+                request_params = json.loads(query['params'][0])
+                if not isinstance(request_params, dict):
+                    raise ValueError("params must be a JSON object.")
+                inference_params.update(request_params)
+            inference_params = validate_inference_params(inference_params)
+            seed = validate_seed(
+                int(query['seed'][0]) if 'seed' in query else None)
+            input_midi = self.rfile.read(
+                int(self.headers.get('Content-Length', 0)))
+            if not input_midi:
+                raise ValueError("The request has no midi file.")
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        try:
+            output_midi = self.server.batcher.generate_composition_bytes(
+                input_midi, inference_params, seed)
+        except InvalidRequestError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            logger.exception("Unable to generate composition.")
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send(200, output_midi, 'audio/midi')
+
+    def log_message(self, format, *args):
+        # Unix socket clients have no address to log
+        logger.info(format % args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(batcher,
+                  inference_params,
+                  host='127.0.0.1',
+                  port=8080,
+                  socket_path=None):
+    """
+    Creates the HTTP server, call serve_forever to start it
+
+    Parameters
+    ----------
+    batcher : MicroBatcher
+        batcher that samples the requests
+    inference_params : json
+        JSON with the default inference parameters
+    host : str
+        address to listen on
+    port : int
+        port to listen on
+    socket_path : str, optional
+        Unix socket to listen on instead of host and port
+
+    Returns
+    -------
+    socketserver.BaseServer
+        the server
+    """
+    if socket_path is not None:
+        server = ThreadingUnixHTTPServer(socket_path, InferenceRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+    server.batcher = batcher
+    server.inference_params = inference_params
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serves AR-CNN compositions over local HTTP")
+    parser.add_argument(
+        '--model',
+        required=True,
+        help="Path to the trained model, or to a serving model directory "
+        "written by ArCnnModel.export_for_serving")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--socket',
+                        help="Unix socket to listen on instead of a port")
+    parser.add_argument('--inference-params',
+                        default='inference_parameters.json',
+                        help="JSON with the default inference parameters")
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-wait-ms', type=float, default=10,
+                        help="Longest wait for more requests to batch")
+    parser.add_argument('--cache-mbytes', type=int, default=64,
+                        help="Size of the input and output cache, 0 disables it")
+    parser.add_argument('--cache-dir',
+                        help="Directory to spill evicted cache entries to")
+    parser.add_argument('--cache-dir-mbytes', type=int, default=1024,
+                        help="Size of the spill files in --cache-dir, the "
+                        "least recently used ones are deleted beyond it")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.inference_params) as json_file:
+        inference_params = json.load(json_file)
+    cache = InferenceCache(
+        args.cache_mbytes * 2**20, args.cache_dir,
+        args.cache_dir_mbytes * 2**20) if args.cache_mbytes else None
+    inference = Inference(cache=cache)
+    inference.load_model(args.model)
+    # Run the model at the batch sizes it will see so that the first
+    # requests do not pay for it
+    logger.info("Model cold start: {}".format(
+        inference.warmup(sorted({1, args.max_batch_size}))))
+    batcher = MicroBatcher(inference, args.max_batch_size,
+                           args.max_wait_ms / 1000)
+    server = create_server(batcher, inference_params, args.host, args.port,
+                           args.socket)
+    logger.info("Serving on {}".format(
+        args.socket or "http://{}:{}".format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -35,3 +35,30 @@ class Loss():
         target = target / K.sum(target)
         output = K.softmax(output)
         return keras.losses.kullback_leibler_divergence(target, output)
+
+    @staticmethod
+    def distillation_kl_loss(temperature=1.0, ground_truth_weight=0.0):
+        '''
+        Loss of a student model trained to match the logits of a teacher model
+        :param temperature: temperature applied to the teacher and student logits
+        :param ground_truth_weight: weight of built_in_softmax_kl_loss against the ground truth
+        :return: loss function of the targets of DistillationGenerator, whose
+        last channel stacks the ground truth and the teacher logits
+        '''
+        def distillation_kl_loss(target_and_teacher_logits, output):
+            target = target_and_teacher_logits[..., :1]
+            teacher_logits = K.batch_flatten(
+                target_and_teacher_logits[..., 1:]) / temperature
+            student_logits = K.batch_flatten(output) / temperature
+            # KL divergence between the teacher and student softmax over
+            # all the cells of every sample, like the sampler at inference.
+            # Scaled by temperature ** 2 to keep the gradients of different
+            # temperatures comparable
+            loss = temperature**2 * keras.losses.kullback_leibler_divergence(
+                K.softmax(teacher_logits), K.softmax(student_logits))
+            if ground_truth_weight:
+                loss = ((1 - ground_truth_weight) * loss + ground_truth_weight *
+                        Loss.built_in_softmax_kl_loss(target, output))
+            return loss
+
+        return distillation_kl_loss
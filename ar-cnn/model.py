@@ -17,10 +17,14 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import os
+import json
 from enum import Enum
+import numpy as np
 from keras.models import Model
-from keras.layers import Input, Conv2D, MaxPooling2D, UpSampling2D, concatenate, BatchNormalization, Dropout
+from keras.layers import Input, Conv2D, SeparableConv2D, MaxPooling2D, UpSampling2D, concatenate, BatchNormalization, Dropout
 from keras.optimizers import Adam, RMSprop
+from texttable import Texttable
 from losses import Loss
 
 
@@ -36,7 +40,8 @@ class ArCnnModel():
                  batch_norm_decoder,
                  learning_rate,
                  optimizer_enum,
-                 pre_trained=None):
+                 pre_trained=None,
+                 conv_type=None):
 
         # PianoRoll Input Dimensions
         self.input_dim = input_dim
@@ -60,12 +65,97 @@ class ArCnnModel():
         self.learning_rate = learning_rate
         # Optimizer to use while training the model
         self.optimizer_enum = optimizer_enum
+        # Type of the 3x3 convolutions of the encoder, bottleneck and decoder
+        self.conv_type = ConvType.STANDARD if conv_type is None else conv_type
         if self.num_layers < 1:
             raise ValueError(
                 "Number of layers should be greater than or equal to 1")
+        # Every encoder layer halves the timesteps and pitches, and the
+        # decoder concatenates them back with the skip connections
+        if (self.input_dim[0] % 2**self.num_layers
+                or self.input_dim[1] % 2**self.num_layers):
+            raise ValueError(
+                "Number of timesteps and pitches should be divisible by "
+                "2 ** number of layers = {}".format(2**self.num_layers))
 
     # Number of times Conv2D to be performed
     CONV_PER_LAYER = 2
+    # Files of a serving model, see export_for_serving
+    SERVING_CONFIG_FILE_NAME = 'config.json'
+    SERVING_WEIGHTS_FILE_NAME = 'model.weights.h5'
+
+    def get_config(self):
+        '''
+        Hyper-parameters that rebuild the same architecture with from_config
+        '''
+        return {
+            'input_dim': list(self.input_dim),
+            'num_filters': self.num_filters,
+            'growth_factor': self.growth_factor,
+            'num_layers': self.num_layers,
+            'dropout_rate_encoder': list(self.dropout_rate_encoder),
+            'dropout_rate_decoder': list(self.dropout_rate_decoder),
+            'batch_norm_encoder': list(self.batch_norm_encoder),
+            'batch_norm_decoder': list(self.batch_norm_decoder),
+            'learning_rate': self.learning_rate,
+            'optimizer_enum': self.optimizer_enum.value,
+            'conv_type': self.conv_type.value
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        :param: config: hyper-parameters returned by get_config
+        '''
+        config = dict(config)
+        config['input_dim'] = tuple(config['input_dim'])
+        config['optimizer_enum'] = OptimizerType(config['optimizer_enum'])
+        config['conv_type'] = ConvType(
+            config.get('conv_type', ConvType.STANDARD.value))
+        return cls(**config)
+
+    def export_for_serving(self, checkpoint_path, serving_dir):
+        '''
+        Saves the hyper-parameters and only the weights of a trained checkpoint.
+        Inference.load_model rebuilds the architecture from them, which is faster
+        than deserializing the full checkpoint with its optimizer state.
+        :param: checkpoint_path: checkpoint saved by training this architecture
+        :param: serving_dir: directory to save the serving model to
+        '''
+        model = self.build_model(compile_model=False)
+        model.load_weights(checkpoint_path)
+        os.makedirs(serving_dir, exist_ok=True)
+        model.save_weights(
+            os.path.join(serving_dir, self.SERVING_WEIGHTS_FILE_NAME))
+        with open(os.path.join(serving_dir, self.SERVING_CONFIG_FILE_NAME),
+                  'w') as config_file:
+            json.dump(self.get_config(), config_file, indent=2)
+
+    def convolution(self, layer_input, num_filters):
+        '''
+        3x3 convolution with a relu activation, of type self.conv_type
+        :param: layer_input: Input Layer to the convolution
+        :param: num_filters: Number of filters
+        '''
+        if self.conv_type == ConvType.STANDARD:
+            return Conv2D(num_filters, (3, 3),
+                          activation='relu',
+                          padding='same')(layer_input)
+        if self.conv_type == ConvType.SEPARABLE:
+            # A 3x3 convolution of every input channel followed by a 1x1
+            # convolution across the channels
+            return SeparableConv2D(num_filters, (3, 3),
+                                   activation='relu',
+                                   padding='same')(layer_input)
+        if self.conv_type == ConvType.FACTORIZED:
+            # A 3x1 convolution over time followed by a 1x3 convolution over pitches
+            layer_output = Conv2D(num_filters, (3, 1),
+                                  activation='relu',
+                                  padding='same')(layer_input)
+            return Conv2D(num_filters, (1, 3),
+                          activation='relu',
+                          padding='same')(layer_output)
+        raise ValueError("Unknown convolution type {}".format(self.conv_type))
 
     def down_sampling(self,
                       layer_input,
@@ -80,9 +170,7 @@ class ArCnnModel():
         '''
         encoder = layer_input
         for _ in range(self.CONV_PER_LAYER):
-            encoder = Conv2D(num_filters, (3, 3),
-                             activation='relu',
-                             padding='same')(encoder)
+            encoder = self.convolution(encoder, num_filters)
             pooling_layer = MaxPooling2D(pool_size=(2, 2))(encoder)
             if dropout_rate:
                 pooling_layer = Dropout(dropout_rate)(pooling_layer)
@@ -107,9 +195,7 @@ class ArCnnModel():
         if batch_normalization:
             decoder = BatchNormalization()(decoder)
         for _ in range(self.CONV_PER_LAYER):
-            decoder = Conv2D(num_filters, (3, 3),
-                             activation='relu',
-                             padding='same')(decoder)
+            decoder = self.convolution(decoder, num_filters)
 
         if dropout_rate:
             decoder = Dropout(dropout_rate)(decoder)
@@ -127,7 +213,11 @@ class ArCnnModel():
             raise Exception("Only Adam and RMSProp optimizers are supported")
         return optimizer
 
-    def build_model(self):
+    def build_model(self, compile_model=True):
+        '''
+        :param: compile_model: Flag to compile the model for training and print
+        its summary, not needed for inference
+        '''
         # Create a list of encoder sampling layers
         down_sampling_layers = []
         up_sampling_layers = []
@@ -147,12 +237,8 @@ class ArCnnModel():
             num_filters *= self.growth_factor
 
         # bottle_neck layer
-        bottle_neck = Conv2D(num_filters, (3, 3),
-                             activation='relu',
-                             padding='same')(pooling_layer)
-        bottle_neck = Conv2D(num_filters, (3, 3),
-                             activation='relu',
-                             padding='same')(bottle_neck)
+        bottle_neck = self.convolution(pooling_layer, num_filters)
+        bottle_neck = self.convolution(bottle_neck, num_filters)
         num_filters //= self.growth_factor
 
         # upsampling layers
@@ -169,14 +255,79 @@ class ArCnnModel():
 
         output = Conv2D(1, 1, activation='linear')(up_sampling_layers[-1])
         model = Model(inputs=inputs, outputs=output)
-        optimizer = self.get_optimizer(self.optimizer_enum, self.learning_rate)
-        model.compile(optimizer=optimizer, loss=Loss.built_in_softmax_kl_loss)
+        if compile_model:
+            optimizer = self.get_optimizer(self.optimizer_enum,
+                                           self.learning_rate)
+            model.compile(optimizer=optimizer,
+                          loss=Loss.built_in_softmax_kl_loss)
         if self.pre_trained:
             model.load_weights(self.pre_trained)
-        model.summary()
+        if compile_model:
+            model.summary()
+            self.print_cost_report(model)
         return model
 
+    @staticmethod
+    def get_cost_report(model):
+        '''
+        Parameters and multiply-accumulates of every layer for one input, the
+        convolutions are the only layers with a significant number of them
+        :param: model: Model built by build_model
+        :return: list of (layer name, layer type, output shape, parameters, multiply-accumulates)
+        '''
+        def get_shape(tensor):
+            return tuple(getattr(dimension, 'value', dimension)
+                         for dimension in tensor.shape)
+
+        report = []
+        for layer in model.layers:
+            output_shape = get_shape(layer.output)
+            multiply_accumulates = 0
+            if isinstance(layer, (Conv2D, SeparableConv2D)):
+                input_channels = get_shape(layer.input)[-1]
+                output_positions = int(np.prod(output_shape[1:-1]))
+                kernel_size = int(np.prod(layer.kernel_size))
+                if isinstance(layer, SeparableConv2D):
+                    depth_channels = input_channels * layer.depth_multiplier
+                    multiply_accumulates = output_positions * depth_channels * (
+                        kernel_size + layer.filters)
+                else:
+                    multiply_accumulates = (output_positions * kernel_size *
+                                            input_channels * layer.filters)
+            report.append((layer.name, type(layer).__name__, output_shape[1:],
+                           layer.count_params(), multiply_accumulates))
+        return report
+
+    @classmethod
+    def print_cost_report(cls, model):
+        '''
+        Prints the parameters and multiply-accumulates of every layer, see get_cost_report
+        :param: model: Model built by build_model
+        '''
+        report = cls.get_cost_report(model)
+        table = Texttable()
+        table.set_cols_align(['l', 'l', 'l', 'r', 'r'])
+        table.add_rows([[
+            "layer", "type", "output shape", "parameters",
+            "multiply-accumulates (M)"
+        ]] + [[
+            name, layer_type, str(output_shape), parameters,
+            "{:.1f}".format(multiply_accumulates / 1e6)
+        ] for name, layer_type, output_shape, parameters,
+              multiply_accumulates in report] + [[
+                  "total", "", "",
+                  sum(row[3] for row in report), "{:.1f}".format(
+                      sum(row[4] for row in report) / 1e6)
+              ]])
+        print(table.draw())
+
 
 class OptimizerType(Enum):
     ADAM = "Adam"
     RMSPROP = "RMSprop"
+
+
+class ConvType(Enum):
+    STANDARD = "standard"
+    SEPARABLE = "separable"
+    FACTORIZED = "factorized"
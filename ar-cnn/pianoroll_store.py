@@ -0,0 +1,370 @@
+# The MIT-Zero License
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import numpy as np
+
+
+class PackedPianoRollStore():
+    '''
+    Holds pianoroll windows bit-packed along the pitch axis.
+    Every timestep of every song is packed once into a single contiguous
+    (timesteps, ceil(pitches / 8)) uint8 array, and windows are rows of an
+    offsets index into it, so overlapping windows share their timesteps.
+    The first and last offset of every window's song are kept as well, so
+    that windows can be shifted in time without leaving their song.
+    '''
+    def __init__(self, timesteps_per_window, number_of_pitches):
+        self.timesteps_per_window = timesteps_per_window
+        self.number_of_pitches = number_of_pitches
+        self.packed_pitches = -(-number_of_pitches // 8)
+        self.packed_timesteps = np.empty((0, self.packed_pitches),
+                                         dtype=np.uint8)
+        self.offsets = np.empty(0, dtype=np.int64)
+        self.offset_bounds = np.empty((0, 2), dtype=np.int64)
+        self._pending_timesteps = []
+        self._pending_offsets = []
+        self._pending_offset_bounds = []
+        self._pending_length = 0
+        self._lookup_tables = {}
+
+    @staticmethod
+    def get_window_starts(pianoroll_length, timesteps_per_window,
+                          time_steps_shifted_per_sample):
+        '''
+        Window start timesteps of a song, matching process_pianoroll
+        :return: truncated pianoroll length, array of window starts
+        '''
+        truncated_pianoroll_length = pianoroll_length - (pianoroll_length %
+                                                         timesteps_per_window)
+        starts = np.arange(
+            0, truncated_pianoroll_length - timesteps_per_window + 1,
+            time_steps_shifted_per_sample)
+        return truncated_pianoroll_length, starts
+
+    @staticmethod
+    def _get_offset_bounds(song_start, truncated_pianoroll_length,
+                           timesteps_per_window, number_of_windows):
+        '''First and last window offset of a song, repeated for each of its windows'''
+        return np.tile([
+            song_start,
+            song_start + truncated_pianoroll_length - timesteps_per_window
+        ], (number_of_windows, 1)).astype(np.int64)
+
+    @classmethod
+    def from_packed_songs(cls, packed_timesteps, song_starts, song_lengths,
+                          timesteps_per_window, time_steps_shifted_per_sample,
+                          number_of_pitches):
+        '''
+        Indexes windows over songs that are already packed, e.g. a memory-mapped cache
+        :param packed_timesteps: uint8 array of shape (timesteps, ceil(number_of_pitches / 8))
+        :param song_starts: first row of every song in packed_timesteps
+        :param song_lengths: number of timesteps of every song
+        '''
+        store = cls(timesteps_per_window, number_of_pitches)
+        store.packed_timesteps = packed_timesteps
+        offsets = [np.empty(0, dtype=np.int64)]
+        offset_bounds = [np.empty((0, 2), dtype=np.int64)]
+        for song_start, song_length in zip(song_starts, song_lengths):
+            truncated_pianoroll_length, starts = cls.get_window_starts(
+                song_length, timesteps_per_window,
+                time_steps_shifted_per_sample)
+            offsets.append(song_start + starts)
+            offset_bounds.append(
+                cls._get_offset_bounds(song_start, truncated_pianoroll_length,
+                                       timesteps_per_window, len(starts)))
+        store.offsets = np.concatenate(offsets).astype(np.int64)
+        store.offset_bounds = np.concatenate(offset_bounds)
+        return store
+
+    def add_pianoroll(self, pianoroll, time_steps_shifted_per_sample):
+        '''
+        Packs a song and indexes the same windows as process_pianoroll
+        :param pianoroll: pianoroll of shape (timesteps, number_of_pitches)
+        :param time_steps_shifted_per_sample: number of bars to be shifted in timesteps
+        :return: number of windows added
+        '''
+        return self.add_packed_pianoroll(
+            np.packbits(pianoroll.astype(np.bool_, copy=False), axis=-1),
+            time_steps_shifted_per_sample)
+
+    def add_packed_pianoroll(self, packed_pianoroll,
+                             time_steps_shifted_per_sample):
+        '''
+        Indexes the windows of a song that is already packed along the pitch axis
+        :param packed_pianoroll: uint8 array of shape (timesteps, ceil(number_of_pitches / 8))
+        :param time_steps_shifted_per_sample: number of bars to be shifted in timesteps
+        :return: number of windows added
+        '''
+        truncated_pianoroll_length, starts = self.get_window_starts(
+            packed_pianoroll.shape[0], self.timesteps_per_window,
+            time_steps_shifted_per_sample)
+        if len(starts) == 0:
+            return 0
+        start = len(self.packed_timesteps) + self._pending_length
+        self._pending_timesteps.append(
+            packed_pianoroll[:truncated_pianoroll_length])
+        self._pending_offsets.append(start + starts)
+        self._pending_offset_bounds.append(
+            self._get_offset_bounds(start, truncated_pianoroll_length,
+                                    self.timesteps_per_window, len(starts)))
+        self._pending_length += truncated_pianoroll_length
+        return len(starts)
+
+    def add_window(self, window):
+        '''
+        Packs a single (timesteps_per_window, number_of_pitches) window
+        '''
+        return self.add_pianoroll(window, self.timesteps_per_window)
+
+    def _consolidate(self):
+        if self._pending_timesteps:
+            self.packed_timesteps = np.concatenate([self.packed_timesteps] +
+                                                   self._pending_timesteps)
+            self.offsets = np.concatenate([self.offsets] +
+                                          self._pending_offsets)
+            self.offset_bounds = np.concatenate([self.offset_bounds] +
+                                                self._pending_offset_bounds)
+            self._pending_timesteps = []
+            self._pending_offsets = []
+            self._pending_offset_bounds = []
+            self._pending_length = 0
+
+    def take(self, indices):
+        '''
+        Returns a store with the selected windows, e.g. for shuffling or
+        for the training / validation split. The packed timesteps are shared.
+        '''
+        self._consolidate()
+        store = PackedPianoRollStore(self.timesteps_per_window,
+                                     self.number_of_pitches)
+        store.packed_timesteps = self.packed_timesteps
+        store.offsets = self.offsets[indices]
+        store.offset_bounds = self.offset_bounds[indices]
+        return store
+
+    def _get_lookup_table(self, dtype):
+        '''
+        Maps every byte value to its 8 unpacked bits in the requested dtype
+        '''
+        lookup_table = self._lookup_tables.get(dtype)
+        if lookup_table is None:
+            byte_values = np.arange(256, dtype=np.uint8)[:, np.newaxis]
+            lookup_table = np.unpackbits(byte_values, axis=1).astype(dtype)
+            self._lookup_tables[dtype] = lookup_table
+        return lookup_table
+
+    def unpack_batch(self, indices, out=None, time_shifts=None):
+        '''
+        Unpacks windows into a (len(indices), timesteps_per_window, number_of_pitches) buffer
+        :param indices: indices of the windows to unpack
+        :param out: optional preallocated C-contiguous buffer to write into
+        :param time_shifts: optional number of timesteps every window start is
+        moved by, clipped so that the window stays within its song
+        :return: the buffer holding the unpacked windows
+        '''
+        self._consolidate()
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        offsets = self.offsets[indices]
+        if time_shifts is not None:
+            offset_bounds = self.offset_bounds[indices]
+            offsets = np.clip(offsets + time_shifts, offset_bounds[:, 0],
+                              offset_bounds[:, 1])
+        shape = (len(indices), self.timesteps_per_window,
+                 self.number_of_pitches)
+        if out is None:
+            out = np.empty(shape, dtype=np.bool_)
+        elif out.shape != shape:
+            raise ValueError(
+                "Expected an output buffer of shape {}, got {}".format(
+                    shape, out.shape))
+        rows = offsets[:, np.newaxis] + np.arange(
+            self.timesteps_per_window)
+        packed_windows = self.packed_timesteps[rows]
+        if self.number_of_pitches % 8 == 0 and out.flags.c_contiguous:
+            # Expand every byte through the lookup table straight into the buffer
+            np.take(self._get_lookup_table(out.dtype),
+                    packed_windows,
+                    axis=0,
+                    out=out.reshape(shape[:2] + (self.packed_pitches, 8)),
+                    mode='clip')
+        else:
+            out[...] = np.unpackbits(packed_windows,
+                                     axis=-1)[..., :self.number_of_pitches]
+        return out
+
+    @property
+    def nbytes(self):
+        self._consolidate()
+        return self.packed_timesteps.nbytes + self.offsets.nbytes
+
+    def get_fingerprint(self):
+        '''
+        Hash of the windows, computed from the packed timesteps they cover
+        without unpacking them, so overlapping windows are hashed once
+        :return: hex digest
+        '''
+        self._consolidate()
+        fingerprint = hashlib.sha1()
+        fingerprint.update(
+            np.array([self.timesteps_per_window, self.number_of_pitches],
+                     dtype=np.int64).tobytes())
+        fingerprint.update(self.offsets.tobytes())
+        # Number of windows covering every timestep
+        coverage = np.zeros(len(self.packed_timesteps) + 1, dtype=np.int64)
+        np.add.at(coverage, self.offsets, 1)
+        np.add.at(coverage, self.offsets + self.timesteps_per_window, -1)
+        covered_timesteps = np.cumsum(coverage[:-1]) > 0
+        fingerprint.update(
+            np.ascontiguousarray(self.packed_timesteps[covered_timesteps]))
+        return fingerprint.hexdigest()
+
+    def __getitem__(self, index):
+        return self.unpack_batch([index])[0]
+
+    def __len__(self):
+        return len(self.offsets) + sum(
+            len(offsets) for offsets in self._pending_offsets)
+
+
+class PianoRollWindowStore():
+    '''
+    Holds every song's pianoroll once and indexes windows as (song_id, offset)
+    pairs. Windows are only cut out of strided views of the songs when a batch
+    is assembled, so memory scales with the total length of the songs and the
+    shift between windows can be changed without processing the songs again.
+    '''
+    def __init__(self, timesteps_per_window, time_steps_shifted_per_sample):
+        self.timesteps_per_window = timesteps_per_window
+        self.time_steps_shifted_per_sample = time_steps_shifted_per_sample
+        self.songs = []
+        self.windows = np.empty((0, 2), dtype=np.int64)
+        self._song_views = {}
+
+    def _get_song_windows(self, song_id):
+        '''(song_id, offset) pairs of the windows of a song'''
+        _, starts = PackedPianoRollStore.get_window_starts(
+            len(self.songs[song_id]), self.timesteps_per_window,
+            self.time_steps_shifted_per_sample)
+        return np.stack([np.full(len(starts), song_id), starts], axis=1)
+
+    def add_pianoroll(self, pianoroll):
+        '''
+        Adds a song without copying it
+        :param pianoroll: pianoroll of shape (timesteps, number_of_pitches)
+        :return: number of windows added
+        '''
+        truncated_pianoroll_length, _ = PackedPianoRollStore.get_window_starts(
+            pianoroll.shape[0], self.timesteps_per_window,
+            self.time_steps_shifted_per_sample)
+        self.songs.append(pianoroll[:truncated_pianoroll_length])
+        song_windows = self._get_song_windows(len(self.songs) - 1)
+        self.windows = np.concatenate([self.windows, song_windows])
+        return len(song_windows)
+
+    def set_time_steps_shifted_per_sample(self, time_steps_shifted_per_sample):
+        '''Re-indexes the windows of every song with a new shift'''
+        self.time_steps_shifted_per_sample = time_steps_shifted_per_sample
+        self.windows = np.concatenate([np.empty((0, 2), dtype=np.int64)] + [
+            self._get_song_windows(song_id)
+            for song_id in range(len(self.songs))
+        ])
+
+    def get_song_view(self, song_id):
+        '''
+        Read only view of shape (timesteps - timesteps_per_window + 1,
+        timesteps_per_window, number_of_pitches) over every window of a song
+        '''
+        song_view = self._song_views.get(song_id)
+        if song_view is None:
+            song = self.songs[song_id]
+            # Same view as np.lib.stride_tricks.sliding_window_view, which
+            # needs numpy >= 1.20
+            song_view = np.lib.stride_tricks.as_strided(
+                song,
+                shape=(len(song) - self.timesteps_per_window + 1,
+                       self.timesteps_per_window, song.shape[1]),
+                strides=(song.strides[0], ) + song.strides,
+                writeable=False)
+            self._song_views[song_id] = song_view
+        return song_view
+
+    def take(self, indices):
+        '''
+        Returns a store with the selected windows, e.g. for shuffling or
+        for the training / validation split. The songs are shared.
+        '''
+        store = PianoRollWindowStore(self.timesteps_per_window,
+                                     self.time_steps_shifted_per_sample)
+        store.songs = self.songs
+        store.windows = self.windows[indices]
+        store._song_views = self._song_views
+        return store
+
+    def unpack_batch(self, indices, out=None, time_shifts=None):
+        '''
+        Copies windows into a (len(indices), timesteps_per_window, number_of_pitches) buffer
+        :param indices: indices of the windows to copy
+        :param out: optional preallocated buffer to write into
+        :param time_shifts: optional number of timesteps every window start is
+        moved by, clipped so that the window stays within its song
+        :return: the buffer holding the windows
+        '''
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        if out is None:
+            out = np.empty(
+                (len(indices), self.timesteps_per_window) +
+                self.songs[0].shape[1:],
+                dtype=np.bool_)
+        windows = self.windows[indices]
+        if time_shifts is not None:
+            windows = windows.copy()
+            windows[:, 1] += time_shifts
+        for batch_index, (song_id, offset) in enumerate(windows):
+            song_view = self.get_song_view(song_id)
+            out[batch_index] = song_view[min(max(offset, 0),
+                                             len(song_view) - 1)]
+        return out
+
+    @property
+    def nbytes(self):
+        return sum(song.nbytes for song in self.songs) + self.windows.nbytes
+
+    def get_fingerprint(self):
+        '''
+        Hash of the windows, computed from the songs they are cut from,
+        so overlapping windows are hashed once
+        :return: hex digest
+        '''
+        fingerprint = hashlib.sha1()
+        fingerprint.update(
+            np.array([self.timesteps_per_window], dtype=np.int64).tobytes())
+        fingerprint.update(self.windows.tobytes())
+        for song_id in np.unique(self.windows[:, 0]):
+            fingerprint.update(
+                np.packbits(self.songs[song_id].astype(np.bool_, copy=False),
+                            axis=-1).tobytes())
+        return fingerprint.hexdigest()
+
+    def __getitem__(self, index):
+        song_id, offset = self.windows[index]
+        return self.get_song_view(song_id)[offset]
+
+    def __len__(self):
+        return len(self.windows)
@@ -0,0 +1,116 @@
+# The MIT-Zero License
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import numpy as np
+import tensorflow as tf
+
+
+class QuantizedModel:
+    """
+    Int8 TensorFlow Lite model written by export_quantized_model, with the
+    predict and get_weights methods that Inference uses from a keras model.
+    Not thread safe, like every TensorFlow Lite interpreter.
+    """
+    def __init__(self, model_path, num_threads=None):
+        with open(model_path, 'rb') as model_file:
+            self.model_content = model_file.read()
+        self.interpreter = tf.lite.Interpreter(
+            model_content=self.model_content, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def predict(self, input_tensor):
+        """
+        Runs the model on a batch
+
+        Parameters
+        ----------
+        input_tensor : 4d numpy array
+            (N, timesteps, pitches, 1) input tensors
+
+        Returns
+        -------
+        4d numpy array
+            float32 logits of the same shape
+        """
+        input_tensor = np.asarray(input_tensor, dtype=np.float32)
+        # Resizing reallocates the interpreter buffers, which are reused
+        # as long as the batch size does not change
+        if len(input_tensor) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index,
+                                                 input_tensor.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(input_tensor)
+        self.interpreter.set_tensor(self.input_index, input_tensor)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+    def get_weights(self):
+        """
+        Returns
+        -------
+        list of numpy array
+            the serialized model, e.g. for Inference.get_model_hash
+        """
+        return [np.frombuffer(self.model_content, dtype=np.uint8)]
+
+
+def export_quantized_model(model,
+                           calibration_generator,
+                           output_path,
+                           number_of_calibration_batches=16):
+    """
+    Quantizes the weights and activations of a trained model to int8 and
+    writes it as a TensorFlow Lite model that Inference.load_model runs.
+    Inputs and outputs stay float32. Requires a TensorFlow 2 keras model.
+
+    Parameters
+    ----------
+    model : keras model
+        trained model
+    calibration_generator : PianoRollGenerator
+        generator of training windows with notes added and removed like the
+        sampler inputs, used to calibrate the activation ranges
+    output_path : str
+        path of the .tflite file to write
+    number_of_calibration_batches : int
+        number of batches of calibration_generator to calibrate on
+
+    Returns
+    -------
+    None
+    """
+    def representative_dataset():
+        for index in range(
+                min(number_of_calibration_batches,
+                    len(calibration_generator))):
+            inputs, _ = calibration_generator[index]
+            for sample in inputs:
+                yield [sample[np.newaxis].astype(np.float32)]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS_INT8
+    ]
+    model_content = converter.convert()
+    with open(output_path, 'wb') as model_file:
+        model_file.write(model_content)
@@ -0,0 +1,221 @@
+# The MIT-Zero License
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import json
+import hashlib
+import numpy as np
+from constants import Constants
+from pianoroll_store import PackedPianoRollStore
+from utils.midi_utils import parse_midi, crop_pitches
+
+
+class MidiCache():
+    '''
+    Persistent cache of parsed pianorolls.
+    Every parsed song is appended bit-packed to a single data file that is
+    memory-mapped on later runs, and a JSON manifest maps the content hash of
+    each MIDI file to its rows. Only new or changed files are parsed again.
+    The manifest also keeps the size, modification time and content hash of
+    every MIDI file path, so only files whose stat changed are read and hashed.
+    '''
+    DATA_FILE_NAME = 'pianorolls.bin'
+    MANIFEST_FILE_NAME = 'manifest.json'
+    VERSION = 1
+
+    def __init__(self,
+                 cache_dir,
+                 beat_resolution,
+                 number_of_pitches=Constants.number_of_pitches,
+                 lowest_pitch=Constants.lowest_pitch):
+        self.cache_dir = cache_dir
+        self.beat_resolution = beat_resolution
+        self.number_of_pitches = number_of_pitches
+        self.lowest_pitch = lowest_pitch
+        self.packed_pitches = -(-number_of_pitches // 8)
+        self.data_file_path = os.path.join(cache_dir, self.DATA_FILE_NAME)
+        self.manifest_file_path = os.path.join(cache_dir,
+                                               self.MANIFEST_FILE_NAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.manifest = self._load_manifest()
+        self._packed_timesteps = None
+
+    def _get_parameters(self):
+        # Parameters that change the parsed pianorolls invalidate the cache
+        return {
+            'version': self.VERSION,
+            'beat_resolution': self.beat_resolution,
+            'number_of_pitches': self.number_of_pitches,
+            'lowest_pitch': self.lowest_pitch
+        }
+
+    def _load_manifest(self):
+        if os.path.isfile(self.manifest_file_path):
+            with open(self.manifest_file_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('parameters') == self._get_parameters():
+                # Manifests written before file stats were kept
+                manifest.setdefault('files', {})
+                return manifest
+            print("Cache parameters changed. Rebuilding the cache in {}".format(
+                self.cache_dir))
+        if os.path.isfile(self.data_file_path):
+            os.remove(self.data_file_path)
+        return {
+            'parameters': self._get_parameters(),
+            'songs': {},
+            'invalid': [],
+            'files': {}
+        }
+
+    def _save_manifest(self):
+        # Write then rename so that a crash never leaves a partial manifest
+        temporary_file_path = self.manifest_file_path + '.tmp'
+        with open(temporary_file_path, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file)
+        os.replace(temporary_file_path, self.manifest_file_path)
+
+    @staticmethod
+    def get_content_hash(midi_file):
+        with open(midi_file, 'rb') as midi_data:
+            return hashlib.sha1(midi_data.read()).hexdigest()
+
+    def _get_cached_content_hash(self, midi_file):
+        '''Content hash of a midi file, only read and hashed if its size or
+        modification time changed since it was last hashed
+        :return: content hash, True if the manifest changed
+        '''
+        file_stat = os.stat(midi_file)
+        file_key = os.path.abspath(midi_file)
+        cached = self.manifest['files'].get(file_key)
+        if cached is not None and cached[:2] == [
+                file_stat.st_size, file_stat.st_mtime_ns
+        ]:
+            return cached[2], False
+        content_hash = self.get_content_hash(midi_file)
+        self.manifest['files'][file_key] = [
+            file_stat.st_size, file_stat.st_mtime_ns, content_hash
+        ]
+        return content_hash, True
+
+    def update(self, midi_files):
+        '''Parses the midi files missing from the cache and appends them
+        :param midi_files: Paths to midi files
+        :return: list with the content hash of each midi file, None if it is invalid
+        '''
+        content_hashes = []
+        invalid_hashes = set(self.manifest['invalid'])
+        rows = self._get_number_of_rows()
+        manifest_changed = False
+        with open(self.data_file_path, 'ab') as data_file:
+            for midi_file in midi_files:
+                content_hash, file_changed = self._get_cached_content_hash(
+                    midi_file)
+                manifest_changed |= file_changed
+                if content_hash in invalid_hashes:
+                    content_hashes.append(None)
+                    continue
+                if content_hash not in self.manifest['songs']:
+                    try:
+                        pianoroll = crop_pitches(
+                            parse_midi(midi_file, self.beat_resolution),
+                            self.lowest_pitch, self.number_of_pitches)
+                    except Exception:
+                        print("midi file: {} is invalid. Ignoring during "
+                              "preprocessing".format(midi_file))
+                        self.manifest['invalid'].append(content_hash)
+                        invalid_hashes.add(content_hash)
+                        manifest_changed = True
+                        content_hashes.append(None)
+                        continue
+                    data_file.write(
+                        np.packbits(pianoroll.astype(np.bool_, copy=False),
+                                    axis=-1).tobytes())
+                    self.manifest['songs'][content_hash] = {
+                        'start': rows,
+                        'length': len(pianoroll)
+                    }
+                    rows += len(pianoroll)
+                    manifest_changed = True
+                content_hashes.append(content_hash)
+        if manifest_changed:
+            self._save_manifest()
+            self._packed_timesteps = None
+        return content_hashes
+
+    def _get_number_of_rows(self):
+        if not os.path.isfile(self.data_file_path):
+            return 0
+        # Rows past the last song in the manifest are leftovers of an
+        # interrupted update and get overwritten by the next song
+        rows = max([
+            song['start'] + song['length']
+            for song in self.manifest['songs'].values()
+        ] + [0])
+        with open(self.data_file_path, 'r+b') as data_file:
+            data_file.truncate(rows * self.packed_pitches)
+        return rows
+
+    @property
+    def packed_timesteps(self):
+        '''Memory-mapped (timesteps, ceil(number_of_pitches / 8)) array of all cached songs'''
+        if self._packed_timesteps is None:
+            if os.path.getsize(self.data_file_path) == 0:
+                return np.empty((0, self.packed_pitches), dtype=np.uint8)
+            self._packed_timesteps = np.memmap(
+                self.data_file_path, dtype=np.uint8,
+                mode='r').reshape(-1, self.packed_pitches)
+        return self._packed_timesteps
+
+    def get_pianoroll(self, midi_file):
+        '''Returns the parsed pianoroll of a midi file, parsing it if it is not cached
+        :param midi_file: Path to midi file
+        :return: parsed pianoroll
+        '''
+        content_hash, = self.update([midi_file])
+        if content_hash is None:
+            return None
+        song = self.manifest['songs'][content_hash]
+        packed_pianoroll = self.packed_timesteps[song['start']:song['start'] +
+                                                 song['length']]
+        return np.unpackbits(packed_pianoroll,
+                             axis=-1)[:, :self.number_of_pitches].astype(
+                                 np.bool_)
+
+    def generate_samples(self, midi_files, bars, beats_per_bar,
+                         bars_shifted_per_sample):
+        '''Cached counterpart of generate_samples
+        :param midi_files: All files in the dataset
+        :return: PackedPianoRollStore of piano roll samples sized to X bars,
+        backed by the memory-mapped cache
+        '''
+        timesteps_per_nbars = bars * beats_per_bar * self.beat_resolution
+        time_steps_shifted_per_sample = (bars_shifted_per_sample *
+                                         beats_per_bar * self.beat_resolution)
+        songs = [
+            self.manifest['songs'][content_hash]
+            for content_hash in self.update(midi_files)
+            if content_hash is not None
+        ]
+        # Windows are only an index over the cached songs,
+        # so changing bars or bars_shifted_per_sample needs no parsing
+        return PackedPianoRollStore.from_packed_songs(
+            self.packed_timesteps, [song['start'] for song in songs],
+            [song['length'] for song in songs], timesteps_per_nbars,
+            time_steps_shifted_per_sample, self.number_of_pitches)
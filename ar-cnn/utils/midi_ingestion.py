@@ -0,0 +1,196 @@
+# The MIT-Zero License
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import time
+import functools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from texttable import Texttable
+from constants import Constants
+from pianoroll_store import PackedPianoRollStore
+from utils.midi_utils import parse_midi, crop_pitches
+
+
+class IngestionReport():
+    '''Outcome of ingesting a list of midi files'''
+    def __init__(self):
+        # (midi file, number of windows) of every parsed midi file
+        self.parsed = []
+        # (midi file, reason) of every midi file that parsed but gave no windows
+        self.skipped = []
+        # (midi file, reason) of every midi file that could not be parsed
+        self.failed = []
+        self.elapsed_seconds = 0.0
+
+    @property
+    def number_of_windows(self):
+        return sum(number_of_windows for _, number_of_windows in self.parsed)
+
+    @property
+    def windows_per_second(self):
+        if self.elapsed_seconds == 0:
+            return 0.0
+        return self.number_of_windows / self.elapsed_seconds
+
+    def print_summary(self):
+        summary = [
+            len(self.parsed),
+            len(self.skipped),
+            len(self.failed), self.number_of_windows, self.elapsed_seconds,
+            self.windows_per_second
+        ]
+        table = Texttable()
+        table.add_rows([[
+            "parsed", "skipped", "failed", "windows", "seconds",
+            "windows_per_second"
+        ], summary])
+        print(table.draw())
+        for midi_file, reason in self.failed:
+            print("midi file: {} failed: {}".format(midi_file, reason))
+
+
+def _parse_and_pack_midi(midi_file, beat_resolution, lowest_pitch,
+                         number_of_pitches):
+    '''Runs in the worker processes. Packing the pianoroll before it is sent
+    back to the parent process makes the transfer 8x smaller.
+    :return: midi file, packed pianoroll (None on failure), number of timesteps or failure reason
+    '''
+    try:
+        pianoroll = crop_pitches(parse_midi(midi_file, beat_resolution),
+                                 lowest_pitch, number_of_pitches)
+    except Exception as e:
+        return midi_file, None, "{}: {}".format(type(e).__name__, e)
+    return midi_file, np.packbits(pianoroll.astype(np.bool_, copy=False),
+                                  axis=-1), len(pianoroll)
+
+
+def _parse_and_pack_midi_chunk(midi_files, **kwargs):
+    '''Runs _parse_and_pack_midi on a chunk of midi files in one worker task'''
+    return [_parse_and_pack_midi(midi_file, **kwargs) for midi_file in midi_files]
+
+
+def _parse_in_own_process(midi_file, worker):
+    '''Parses a midi file in a process of its own, so that a crash of the
+    native midi parser is attributed to the midi file that caused it'''
+    with ProcessPoolExecutor(1) as executor:
+        try:
+            return executor.submit(worker, [midi_file]).result()
+        except BrokenProcessPool:
+            return [(midi_file, None,
+                     "worker process died while parsing the midi file")]
+
+
+def ingest_midi_files(midi_files,
+                      bars,
+                      beats_per_bar,
+                      beat_resolution,
+                      bars_shifted_per_sample,
+                      number_of_workers=None,
+                      chunksize=8,
+                      lowest_pitch=Constants.lowest_pitch,
+                      number_of_pitches=Constants.number_of_pitches):
+    '''Parallel counterpart of generate_samples. Parses the midi files across a
+    process pool and isolates failures to the midi file that caused them.
+    A worker process that dies, e.g. a crash or an out of memory kill in the native
+    midi parser, only fails the midi file it was parsing: the midi files that were
+    in flight are parsed again one per process, and the pool is restarted.
+    :param midi_files: All files in the dataset, repeated entries are reported as skipped
+    :param number_of_workers: Number of worker processes, defaults to the number of cores
+    :param chunksize: Number of midi files sent to a worker at a time
+    :param lowest_pitch: lowest pitch of the pitch window the songs are cropped to
+    :param number_of_pitches: number of pitches of the pitch window
+    :return: PackedPianoRollStore of piano roll samples sized to X bars, IngestionReport
+    '''
+    timesteps_per_nbars = bars * beats_per_bar * beat_resolution
+    time_steps_shifted_per_sample = (bars_shifted_per_sample * beats_per_bar *
+                                     beat_resolution)
+    report = IngestionReport()
+    start_time = time.time()
+    results = {}
+    failures = {}
+    worker = functools.partial(_parse_and_pack_midi_chunk,
+                               beat_resolution=beat_resolution,
+                               lowest_pitch=lowest_pitch,
+                               number_of_pitches=number_of_pitches)
+
+    def add_results(chunk_results):
+        for midi_file, packed_pianoroll, details in chunk_results:
+            if packed_pianoroll is None:
+                failures[midi_file] = details
+            else:
+                results[midi_file] = packed_pianoroll, details
+
+    midi_files = list(midi_files)
+    unique_midi_files = list(dict.fromkeys(midi_files))
+    chunks = [
+        unique_midi_files[first:first + chunksize]
+        for first in range(0, len(unique_midi_files), chunksize)
+    ]
+    number_of_workers = number_of_workers or os.cpu_count() or 1
+    # Bounds the number of midi files to parse again when a worker dies
+    max_chunks_in_flight = 2 * number_of_workers
+    next_chunk = 0
+    while next_chunk < len(chunks):
+        lost_midi_files = []
+        with ProcessPoolExecutor(number_of_workers) as executor:
+            in_flight = {}
+            while (next_chunk < len(chunks) or in_flight) and not lost_midi_files:
+                while (next_chunk < len(chunks)
+                       and len(in_flight) < max_chunks_in_flight):
+                    future = executor.submit(worker, chunks[next_chunk])
+                    in_flight[future] = chunks[next_chunk]
+                    next_chunk += 1
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                if any(future.exception() is not None for future in done):
+                    # Every chunk in flight fails with the pool
+                    done, _ = wait(in_flight)
+                for future in done:
+                    chunk = in_flight.pop(future)
+                    try:
+                        add_results(future.result())
+                    except BrokenProcessPool:
+                        lost_midi_files.extend(chunk)
+        for midi_file in lost_midi_files:
+            add_results(_parse_in_own_process(midi_file, worker))
+
+    # Songs are added in input order so that the windows are reproducible
+    store = PackedPianoRollStore(timesteps_per_nbars, number_of_pitches)
+    reported = set()
+    for midi_file in midi_files:
+        if midi_file in reported:
+            report.skipped.append(
+                (midi_file, "repeats an earlier entry of the midi files"))
+            continue
+        reported.add(midi_file)
+        if midi_file in failures:
+            report.failed.append((midi_file, failures.pop(midi_file)))
+            continue
+        packed_pianoroll, number_of_timesteps = results.pop(midi_file)
+        number_of_windows = store.add_packed_pianoroll(
+            packed_pianoroll, time_steps_shifted_per_sample)
+        if number_of_windows == 0:
+            report.skipped.append(
+                (midi_file, "{} timesteps is shorter than {} bars".format(
+                    number_of_timesteps, bars)))
+        else:
+            report.parsed.append((midi_file, number_of_windows))
+    report.elapsed_seconds = time.time() - start_time
+    return store, report
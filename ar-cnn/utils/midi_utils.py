@@ -22,23 +22,20 @@ from music21 import midi
 import pypianoroll
 from pypianoroll import Multitrack
 from texttable import Texttable
+from constants import Constants
 
 
-def process_midi(midi_file, beat_resolution):
-    '''Takes path to an input midi file and parses it to pianoroll
+def parse_midi(midi_file, beat_resolution):
+    '''Takes path to an input midi file and parses it to pianoroll,
+    raising an exception if the file cannot be parsed
     :param input_midi: Path to midi file
     :param beat_resolution
     :return: parsed painoroll
     '''
     multi_track = pypianoroll.Multitrack(beat_resolution=beat_resolution)
-    try:
-        multi_track.parse_midi(midi_file,
-                               algorithm='custom',
-                               first_beat_time=0)
-    except:
-        print("midi file: {} is invalid. Ignoring during preprocessing".format(
-            midi_file))
-        pass
+    multi_track.parse_midi(midi_file, algorithm='custom', first_beat_time=0)
+    if len(multi_track.tracks) == 0:
+        raise ValueError("midi file: {} has no tracks".format(midi_file))
     # Convert the PianoRoll to binary ignoring the values of velocities
     multi_track.binarize()
     track_indices = list(np.arange(len(
@@ -50,14 +47,65 @@ def process_midi(midi_file, beat_resolution):
     return pianoroll
 
 
-def process_pianoroll(pianoroll, time_steps_shifted_per_sample,
-                      timesteps_per_nbars):
+def process_midi(midi_file, beat_resolution):
+    '''Takes path to an input midi file and parses it to pianoroll
+    :param input_midi: Path to midi file
+    :param beat_resolution
+    :return: parsed painoroll, empty if the midi file is invalid
+    '''
+    try:
+        return parse_midi(midi_file, beat_resolution)
+    except Exception:
+        print("midi file: {} is invalid. Ignoring during preprocessing".format(
+            midi_file))
+        return np.zeros((0, Constants.number_of_midi_pitches), dtype=np.bool_)
+
+
+def crop_pitches(pianoroll, lowest_pitch=0, number_of_pitches=None):
+    '''Keeps the pitch window [lowest_pitch, lowest_pitch + number_of_pitches) of a pianoroll
+    :param pianoroll: pianoroll of shape (timesteps, pitches)
+    :param lowest_pitch: lowest pitch kept
+    :param number_of_pitches: number of pitches kept, all the pitches from lowest_pitch if None
+    :return: view of the pianoroll of shape (timesteps, number_of_pitches)
+    '''
+    if number_of_pitches is None:
+        number_of_pitches = pianoroll.shape[1] - lowest_pitch
+    if (lowest_pitch < 0 or number_of_pitches <= 0
+            or lowest_pitch + number_of_pitches > pianoroll.shape[1]):
+        raise ValueError("Pitch window {}:{} is outside of the {} pitches of "
+                         "the pianoroll".format(
+                             lowest_pitch, lowest_pitch + number_of_pitches,
+                             pianoroll.shape[1]))
+    return pianoroll[:, lowest_pitch:lowest_pitch + number_of_pitches]
+
+
+def pad_pitches(pianoroll,
+                lowest_pitch=0,
+                number_of_midi_pitches=Constants.number_of_midi_pitches):
+    '''Pads a pianoroll cropped with crop_pitches back to all the midi pitches
+    :param pianoroll: pianoroll of shape (timesteps, number_of_pitches)
+    :param lowest_pitch: lowest pitch of the cropped pianoroll
+    :return: pianoroll of shape (timesteps, number_of_midi_pitches)
+    '''
+    return np.pad(pianoroll,
+                  ((0, 0), (lowest_pitch, number_of_midi_pitches -
+                            lowest_pitch - pianoroll.shape[1])))
+
+
+def process_pianoroll(pianoroll,
+                      time_steps_shifted_per_sample,
+                      timesteps_per_nbars,
+                      lowest_pitch=0,
+                      number_of_pitches=None):
     '''Takes path to an input midi file and parses it to pianoroll
     :param pianoroll: pianoroll obtained after parsing midi file
     :param time_steps_shifted_per_sample: number of bars to be shifted in timesteps
     param timesteps_per_nbars: total number of timesteps to be included in processed pianoroll
+    :param lowest_pitch: lowest pitch of the pitch window the sections are cropped to
+    :param number_of_pitches: number of pitches of the pitch window, see crop_pitches
     :return: parsed painoroll sections
     '''
+    pianoroll = crop_pitches(pianoroll, lowest_pitch, number_of_pitches)
     pianoroll_sections = []
     truncated_pianoroll_length = pianoroll.shape[0] - (pianoroll.shape[0] %
                                                        timesteps_per_nbars)
@@ -89,6 +137,24 @@ def plot_pianoroll(pianoroll, beat_resolution, fig_name=None):
                            beat_resolution)
 
 
+def compute_music_metrics(input_midi, beat_resolution, track=0):
+    """Takes a midifile as an input and Returns the metrics of get_music_metrics
+    :param input_midi: Path to midi file
+    :param beat_resolution:
+    :param track: Instrument number in the multi track midi file
+    :return: dict of n_pitch_classes_used, polyphonic_rate, n_pitches_used and in_scale_rate"""
+
+    midi_data = Multitrack(input_midi, beat_resolution)
+    piano_roll = midi_data.tracks[track].pianoroll
+    return {
+        "n_pitch_classes_used":
+        pypianoroll.metrics.n_pitch_classes_used(piano_roll),
+        "polyphonic_rate": pypianoroll.metrics.polyphonic_rate(piano_roll),
+        "n_pitches_used": pypianoroll.metrics.n_pitches_used(piano_roll),
+        "in_scale_rate": pypianoroll.metrics.in_scale_rate(piano_roll)
+    }
+
+
 def get_music_metrics(input_midi, beat_resolution, track=0):
     """Takes a midifile as an input and Returns the following metrics
     :param input_midi: Path to midi file
@@ -103,19 +169,8 @@ def get_music_metrics(input_midi, beat_resolution, track=0):
         to the total number of nonzero entries in a pianoroll.
     4.) n_pitches_used is the the number of unique pitches used in a pianoroll."""
 
-    midi_data = Multitrack(input_midi, beat_resolution)
-    piano_roll = midi_data.tracks[track].pianoroll
-    n_pitch_classes_used = pypianoroll.metrics.n_pitch_classes_used(piano_roll)
-    polyphonic_rate = pypianoroll.metrics.polyphonic_rate(piano_roll)
-    in_scale_rate = pypianoroll.metrics.in_scale_rate(piano_roll)
-    n_pitches_used = pypianoroll.metrics.n_pitches_used(piano_roll)
-    metrics = [
-        n_pitch_classes_used, polyphonic_rate, n_pitches_used, in_scale_rate
-    ]
-    metrics_table = [[
-        "n_pitch_classes_used", "in_scale_rate", "polyphonic_rate",
-        "n_pitches_used"
-    ], metrics]
+    metrics = compute_music_metrics(input_midi, beat_resolution, track)
+    metrics_table = [list(metrics.keys()), list(metrics.values())]
     table = Texttable()
     table.add_rows(metrics_table)
     print(table.draw())
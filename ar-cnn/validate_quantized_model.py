@@ -0,0 +1,196 @@
+# The MIT-Zero License
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Compares an int8 quantized model to the float model it was exported from.
+# Usage:
+#   python validate_quantized_model.py --model checkpoints/model.h5 \
+#       --quantized-model model.tflite --inputs sample_inputs
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+from texttable import Texttable
+from constants import Constants
+from inference import Inference
+from utils.midi_utils import compute_music_metrics
+
+
+def get_top_k_agreement(float_logits, quantized_logits, k):
+    """
+    Compares the notes the sampler is the most likely to flip
+
+    Parameters
+    ----------
+    float_logits : numpy array
+        logits of the float model for one input
+    quantized_logits : numpy array
+        logits of the quantized model for the same input
+    k : int
+        number of most likely notes to compare
+
+    Returns
+    -------
+    tuple
+        whether the most likely note is the same, and the fraction of the
+        k most likely notes that are the same
+    """
+    float_logits = float_logits.reshape(-1)
+    quantized_logits = quantized_logits.reshape(-1)
+    float_top_k = np.argpartition(-float_logits, k - 1)[:k]
+    quantized_top_k = np.argpartition(-quantized_logits, k - 1)[:k]
+    return (np.argmax(float_logits) == np.argmax(quantized_logits),
+            len(np.intersect1d(float_top_k, quantized_top_k)) / k)
+
+
+def get_mean_predict_seconds(inference, input_tensor, repeats):
+    inference.model.predict(input_tensor)
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        inference.model.predict(input_tensor)
+    return (time.perf_counter() - start_time) / repeats
+
+
+def get_composition_metrics(inference, input_midi_path, inference_params,
+                            seed, output_directory):
+    output_midi_path = os.path.join(
+        output_directory, '{}_{}.mid'.format(type(inference.model).__name__,
+                                             os.path.basename(input_midi_path)))
+    with open(output_midi_path, 'wb') as output_midi:
+        output_midi.write(
+            inference.generate_composition_bytes(input_midi_path,
+                                                 inference_params, seed))
+    return compute_music_metrics(output_midi_path, Constants.beat_resolution)
+
+
+def validate(float_inference, quantized_inference, input_midi_paths,
+             inference_params, top_k, seed, repeats):
+    """
+    Compares the outputs of the quantized and float models on every input
+
+    Returns
+    -------
+    list of dict
+        results of every input, see the columns of print_results
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as output_directory:
+        for input_midi_path in input_midi_paths:
+            input_tensor = float_inference.convert_midi_to_tensor(
+                input_midi_path)
+            top_1_match, top_k_agreement = get_top_k_agreement(
+                float_inference.model.predict(input_tensor),
+                quantized_inference.model.predict(input_tensor), top_k)
+            float_metrics = get_composition_metrics(float_inference,
+                                                    input_midi_path,
+                                                    inference_params, seed,
+                                                    output_directory)
+            quantized_metrics = get_composition_metrics(
+                quantized_inference, input_midi_path, inference_params, seed,
+                output_directory)
+            results.append({
+                'input':
+                os.path.basename(input_midi_path),
+                'top_1_match':
+                bool(top_1_match),
+                'top_k_agreement':
+                top_k_agreement,
+                'metric_deltas': {
+                    name: float(quantized_metrics[name] - float_metrics[name])
+                    for name in float_metrics
+                },
+                'float_predict_seconds':
+                get_mean_predict_seconds(float_inference, input_tensor,
+                                         repeats),
+                'quantized_predict_seconds':
+                get_mean_predict_seconds(quantized_inference, input_tensor,
+                                         repeats)
+            })
+    return results
+
+
+def print_results(results, top_k):
+    metric_names = list(results[0]['metric_deltas'])
+    table = Texttable()
+    table.add_rows([["input", "top-1 match", "top-{} agreement".format(top_k)]
+                    + ["{} delta".format(name) for name in metric_names] +
+                    ["speedup"]] + [[
+                        result['input'], result['top_1_match'],
+                        result['top_k_agreement']
+                    ] + [result['metric_deltas'][name]
+                         for name in metric_names] + [
+                             result['float_predict_seconds'] /
+                             result['quantized_predict_seconds']
+                         ] for result in results])
+    print(table.draw())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares a quantized AR-CNN model to the float model")
+    parser.add_argument('--model', required=True,
+                        help="Path to the float model")
+    parser.add_argument('--quantized-model', required=True,
+                        help="Path to the quantized .tflite model")
+    parser.add_argument('--inputs', default='sample_inputs',
+                        help="Directory of midi files to compare on")
+    parser.add_argument('--inference-params',
+                        default='inference_parameters.json')
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=10,
+                        help="Number of forward passes to time")
+    parser.add_argument('--output', help="Path to write the results JSON to")
+    parser.add_argument(
+        '--min-top-k-agreement', type=float, default=0,
+        help="Fail when the mean top-k agreement is lower than this")
+    args = parser.parse_args()
+
+    with open(args.inference_params) as json_file:
+        inference_params = json.load(json_file)
+    float_inference = Inference()
+    float_inference.load_model(args.model)
+    quantized_inference = Inference()
+    quantized_inference.load_model(args.quantized_model)
+    input_midi_paths = sorted(
+        os.path.join(args.inputs, file_name)
+        for file_name in os.listdir(args.inputs)
+        if file_name.endswith(('.mid', '.midi')))
+
+    results = validate(float_inference, quantized_inference,
+                       input_midi_paths, inference_params, args.top_k,
+                       args.seed, args.repeats)
+    print_results(results, args.top_k)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    mean_top_k_agreement = np.mean(
+        [result['top_k_agreement'] for result in results])
+    print("Mean top-{} agreement: {:.3f}".format(args.top_k,
+                                                 mean_top_k_agreement))
+    if mean_top_k_agreement < args.min_top_k_agreement:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()